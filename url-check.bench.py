@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+# SPDX-License-Identifier: CC0-1.0
+# SPDX-FileCopyrightText: 2023 The Foundation for Public Code <info@publiccode.net>
+
+import datetime
+import docopt
+import http.server
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+uc = __import__("url-check")
+
+default_workdir = "/tmp/url-check-bench"
+
+docopt_str = f"""
+{sys.argv[0]}: Offline benchmark of url-check.py
+
+Generates git repositories of files containing URLs of local web servers,
+then times url-check.py checking them, end to end and for each phase.
+
+Usage:
+        {sys.argv[0]} [options]
+
+Options:
+        -w DIR, --workdir=DIR   directory for the generated repositories,
+                                and the results of url-check.py
+                                [default: {default_workdir}]
+        --repos=N               number of repositories [default: 4]
+        --files=N               number of files in each repository
+                                [default: 50]
+        --file-size=BYTES       size of each file [default: 4096]
+        --urls-per-file=N       URLs in each file [default: 5]
+        --unique-urls=N         number of different URLs [default: 500]
+        --hosts=N               number of sites, served on 127.0.1.1 to
+                                127.0.1.N [default: 4]
+        --latency=SECONDS       time taken by the sites to respond
+                                [default: 0.01]
+        --statuses=MIX          the weights of the status codes of the URLs
+                                [default: 200:90,404:5,500:5]
+        --redirects=FRACTION    fraction of the URLs which redirect
+                                [default: 0.1]
+        --timeouts=FRACTION     fraction of the URLs which time out
+                                [default: 0.01]
+        --timeout=SECONDS       timeout of url-check.py, in whole seconds
+                                [default: 1]
+        --runs=N                times to run url-check.py, the first run
+                                clones the repositories and has no results,
+                                later runs fetch and update the results
+                                [default: 2]
+        --seed=N                seed of the generated URLs and files
+                                [default: 1]
+        --args=ARGS             more options for url-check.py,
+                                e.g.: "--extract=blobs --per-host=8"
+                                [default: ]
+        -o PATH, --output=PATH  path to which to save the timings,
+                                relative to the current directory
+                                [default: url-check-bench.json]
+        --compare=PATH          timings saved by an earlier benchmark,
+                                e.g.: of another commit, to compare with
+
+        -h, --help              Prints this message
+"""
+
+
+# The paths say how to respond, after the latency of the server:
+#	/status/<code>/<n>	responds with the status code
+#	/redirect/<n>	redirects to /status/200/<n>
+#	/slow/<n>	responds after longer than the timeout of url-check.py
+class Bench_Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		return
+
+	def respond(self, code, headers={}):
+		self.send_response(code)
+		for key, val in headers.items():
+			self.send_header(key, val)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def do_HEAD(self):
+		time.sleep(self.server.latency)
+		parts = self.path.split("/")
+		if len(parts) == 4 and parts[1] == "status":
+			return self.respond(int(parts[2]))
+		if len(parts) == 3 and parts[1] == "redirect":
+			return self.respond(301, {"Location": f"/status/200/{parts[2]}"})
+		if len(parts) == 3 and parts[1] == "slow":
+			time.sleep(self.server.slow)
+			return self.respond(200)
+		return self.respond(404)
+
+	def do_GET(self):
+		return self.do_HEAD()
+
+
+class Bench_Server(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, host, latency, slow):
+		super().__init__((host, 0), Bench_Handler)
+		self.latency = latency
+		self.slow = slow
+		self.url = f"http://{host}:{self.server_address[1]}"
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+
+	# clients may give up on a slow response
+	def handle_error(self, request, client_address):
+		return
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+
+# "200:90,404:5,500:5" as {200: 90, 404: 5, 500: 5}
+def parse_statuses(mix):
+	weights = {}
+	for item in mix.split(","):
+		code, weight = item.split(":")
+		weights[int(code)] = float(weight)
+	return weights
+
+
+# the URLs, spread over the servers, each with its response decided by
+# the seeded random, thus the same for the same seed
+def make_urls(rnd, servers, count, statuses, redirects, timeouts):
+	codes = list(statuses.keys())
+	weights = list(statuses.values())
+	urls = []
+	for n in range(count):
+		server = servers[n % len(servers)]
+		roll = rnd.random()
+		if roll < timeouts:
+			path = f"/slow/{n}"
+		elif roll < timeouts + redirects:
+			path = f"/redirect/{n}"
+		else:
+			path = f"/status/{rnd.choices(codes, weights)[0]}/{n}"
+		urls.append(server.url + path)
+	return urls
+
+
+def make_file(rnd, urls, urls_per_file, size):
+	words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur"]
+	lines = []
+	length = 0
+	chosen = rnd.sample(urls, min(urls_per_file, len(urls)))
+	while length < size or chosen:
+		line = " ".join(rnd.choices(words, k=10))
+		if chosen:
+			line += f" [a link]({chosen.pop()})."
+		lines.append(line)
+		length += len(line) + 1
+	return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# (re-)creates a git repository with a single commit of the files
+def make_repo(repo_dir, files):
+	subprocess.run(["rm", "-rf", repo_dir], check=True)
+	for file, contents in files.items():
+		path = os.path.join(repo_dir, file)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as out_file:
+			out_file.write(contents)
+	git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.org"]
+	cmds = [
+			git + ["init", "--quiet", "--initial-branch=main"],
+			git + ["add", "--all"],
+			git + ["commit", "--quiet", "--message", "generated"],
+	]
+	for cmd in cmds:
+		subprocess.run(cmd, cwd=repo_dir, check=True)
+
+
+def make_repos(workdir, rnd, urls, args):
+	repos = {}
+	for r in range(int(args["--repos"])):
+		name = f"bench-{r}"
+		files = {}
+		for f in range(int(args["--files"])):
+			path = f"docs/{f // 100}/page-{f}.md"
+			files[path] = make_file(rnd, urls, int(args["--urls-per-file"]),
+					int(args["--file-size"]))
+		repo_dir = os.path.join(workdir, "repos", name)
+		make_repo(repo_dir, files)
+		repos[name] = {"url": "file://" + repo_dir, "branch": "main"}
+	return repos
+
+
+# quiet, with a fresh set of timings for each run
+class Bench_Context(uc.System_Context):
+
+	def __init__(self):
+		self.timings = {}
+
+	def log(self, *args, **kwargs):
+		return
+
+
+def run_url_check(workdir, config_path, timeout, extra_args):
+	results_path = os.path.join(workdir, "url-check-results.json")
+	argv = [
+			"url-check",
+			f"--gits-dir={os.path.join(workdir, 'gits')}",
+			f"--config={config_path}",
+			f"--results={results_path}",
+			f"--timeout={timeout}",
+	] + extra_args
+	ctx = Bench_Context()
+	start = time.monotonic()
+	uc.main(argv, ctx)
+	timings = {"total": time.monotonic() - start}
+	timings.update(ctx.timings)
+
+	statuses = {}
+	for check in uc.read_results(results_path).values():
+		status = str(check["checks"].get("status"))
+		statuses[status] = statuses.get(status, 0) + 1
+	return {"seconds": timings, "statuses": statuses}
+
+
+def git_commit():
+	cmd = ["git", "describe", "--always", "--dirty"]
+	here = os.path.dirname(os.path.abspath(__file__))
+	result = subprocess.run(cmd, cwd=here, capture_output=True, text=True)
+	return result.stdout.strip()
+
+
+def print_runs(runs, earlier=None):
+	for i, run in enumerate(runs):
+		print(f"run {i + 1}:", run["statuses"])
+		before = {}
+		if earlier and i < len(earlier["runs"]):
+			before = earlier["runs"][i]["seconds"]
+		for phase, seconds in run["seconds"].items():
+			line = f"\t{phase:8} {seconds:8.3f}s"
+			if phase in before and before[phase] > 0:
+				line += f"\t{before[phase]:8.3f}s before, x{seconds / before[phase]:.2f}"
+			print(line)
+
+
+def main(sys_argv=sys.argv):
+	args = docopt.docopt(docopt_str, argv=sys_argv[1:])
+	output_path = os.path.abspath(args["--output"])
+	earlier = None
+	if args["--compare"]:
+		earlier = uc.read_json(args["--compare"])
+
+	workdir = os.path.abspath(args["--workdir"])
+	subprocess.run(["rm", "-rf", workdir], check=True)
+	os.makedirs(workdir)
+	rnd = random.Random(int(args["--seed"]))
+	# url-check.py takes the timeout in whole seconds
+	timeout = int(args["--timeout"])
+
+	# URLs starting with "127.0.0.1" are ignored by default, as the dots of
+	# the pattern match any character, and it is not anchored at the end,
+	# e.g.: "127.0.0.10" is also ignored, thus the sites are on 127.0.1.x
+	hosts = [f"127.0.1.{i + 1}" for i in range(int(args["--hosts"]))]
+	servers = [
+			Bench_Server(host, float(args["--latency"]), timeout + 1)
+			for host in hosts
+	]
+	try:
+		urls = make_urls(rnd, servers, int(args["--unique-urls"]),
+				parse_statuses(args["--statuses"]), float(args["--redirects"]),
+				float(args["--timeouts"]))
+		repos = make_repos(workdir, rnd, urls, args)
+		config_path = os.path.join(workdir, "url-check-config.json")
+		uc.write_json(config_path, {"repositories": repos})
+
+		# the reports of url-check.py are written to the current directory
+		os.chdir(workdir)
+		runs = []
+		for i in range(int(args["--runs"])):
+			runs.append(
+					run_url_check(workdir, config_path, timeout, args["--args"].split()))
+	finally:
+		for server in servers:
+			server.stop()
+
+	print_runs(runs, earlier)
+	uc.write_json(
+			output_path, {
+			"commit": git_commit(),
+			"date": str(datetime.datetime.utcnow()),
+			"options": {
+			key: val
+			for key, val in args.items()
+			if key not in ["--output", "--compare"]
+			},
+			"runs": runs,
+			})
+	print("saved", output_path)
+
+
+if __name__ == "__main__":
+	main()
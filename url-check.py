@@ -2,17 +2,31 @@
 # SPDX-License-Identifier: CC0-1.0
 # SPDX-FileCopyrightText: 2023 The Foundation for Public Code <info@publiccode.net>
 
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
 import datetime
 import docopt
+import email.utils
 import functools
+import hashlib
+import heapq
+import io
 import json
-import multiprocessing
+import math
 import os
 import pathlib
+import pstats
 import re
 import requests
+import socket
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
 import urllib
 
 url_check_version = "0.0.0"
@@ -22,6 +36,7 @@ default_results_json = "url-check-results.json"
 default_config_json = "url-check-config.json"
 default_gits_dir = "/tmp/url-check/gits"
 default_timeout = "10"
+default_public_suffix_list = "/usr/share/publicsuffix/public_suffix_list.dat"
 
 check_fails_json = "url-check-fails.json"
 
@@ -30,6 +45,8 @@ docopt_str = f"""
 
 Usage:
         {sys.argv[0]} [options]
+        {sys.argv[0]} merge [options] SHARD_RESULTS...
+        {sys.argv[0]} daemon [options]
 
 Options:
         -g DIR, --gits-dir=DIR  directory in to which to clone repositories
@@ -37,17 +54,101 @@ Options:
         -c PATH, --config=PATH  path to the config JSON file,
                                 [default: {default_config_json}]
         -r PATH, --results=PATH path to the JSON check results file, if the
-                                file already exists, it will be modified
+                                file already exists, it will be modified,
+                                a path ending in ".db" or ".sqlite" stores
+                                the results in an SQLite database
                                 [default: {default_results_json}]
         -t SECONDS, --timeout=SECONDS
                                 timeout set on the request
                                 [default: {default_timeout}]
+        -x MODE, --extract=MODE how to find the URLs in the repositories:
+                                "files" scans each file separately,
+                                "git-grep" searches each repository with a
+                                single "git grep" (skips binary files),
+                                "blobs" reads the files from the git object
+                                store of a bare clone, without a work tree
+                                [default: files]
+        -e PATH, --extract-cache=PATH
+                                path to the cache of the URLs found in each
+                                file version, relative to the gits dir, or
+                                "none" to disable
+                                [default: url-check-extract-cache.json]
+        --sync-jobs=N           maximum number of repositories cloned or
+                                fetched at once
+                                [default: 8]
+        -j N, --concurrency=N   maximum number of URLs checked at once
+                                [default: 100]
+        --per-host=N            maximum number of URLs checked at once on
+                                any one site (registrable domain)
+                                [default: 4]
+        --per-host-rate=N       maximum number of URLs checks started per
+                                second on any one site, 0 for no limit
+                                [default: 0]
+        --public-suffix-list=PATH
+                                the Public Suffix List, used to find the
+                                registrable domain of each URL
+                                [default: {default_public_suffix_list}]
+        --pool-size=N           connections kept open for reuse per host
+                                [default: 4]
+        --retries=N             times to retry a connection or read error
+                                [default: 0]
+        --no-keep-alive         close each connection after a single check
+        --host-errors=N         consecutive timeouts or connection errors
+                                after which the remaining URLs of a host fail
+                                without being checked, 0 for no limit
+                                [default: 5]
+        --max-retry-after=SECONDS
+                                longest wait for the "Retry-After" of a 429
+                                or 503 response before checking again
+                                [default: 30]
+        -f FORMAT, --format=FORMAT
+                                the format of the results and reports:
+                                "json" or "jsonl" (a line per URL), either
+                                format is read from an existing results file
+                                [default: json]
+        --profile=DIR           profile the run, the main thread and the
+                                worker threads, writing the merged profile
+                                of each phase to the directory
+        -m PATH, --metrics=PATH path to which to write the timings and counts
+                                of the run, in the Prometheus textfile format
+        --deadline=SECONDS      stop checking in time for the run to end
+                                within the seconds, the last tenth of which
+                                is left for writing the results and reports,
+                                the URLs not reached keep their previous
+                                status, and are flagged
+        -i, --incremental       only extract the URLs of the files changed
+                                since the commits of the last incremental run,
+                                and only check the new URLs
+        --checkpoint=SECONDS    write the results so far every so often while
+                                checking, 0 to only write them at the end
+                                [default: 60]
+        -s I/N, --shard=I/N     check only the URLs of the sites (registrable
+                                domains) in shard I of N, numbered from 1,
+                                writing only the results file, for "merge"
+        --interval=SECONDS      for "daemon", the pause between the batches
+                                [default: 60]
+        --batch=N               for "daemon", the number of URLs checked
+                                before the reports are written [default: 500]
+        --resync=MINUTES        for "daemon", the time between the syncs of
+                                the repositories [default: 60]
         -d, --dry-run           do not fetch the URLs or update the checks
 
         -h, --help              Prints this message
         -V, --version           Prints the version ({url_check_version})
         -v, --verbose           Debug output
 
+The "merge" command combines the results files of the shards of a run,
+(see --shard) into the results file and the reports.
+
+Before checking, the hosts of the URLs are looked up at once, only so that
+the URLs of hosts which do not exist fail without a request; the checks
+themselves look up their hosts as usual.
+
+The "daemon" command keeps running, checking the stale URLs in batches,
+the least recently checked first, and writing the reports after each
+batch, while the repositories, caches and connections are kept between
+the batches, and the repositories are synced again every --resync minutes.
+
 DETAILS:
 
 The format of the {default_config_json} is ...
@@ -69,15 +170,195 @@ def read_json(json_file):
 		return json.load(in_file)
 
 
+# In the JSON Lines format, each line is the JSON of a single record,
+# written in sorted order as it goes, rather than serializing the whole
+# object first. A check results record is the entry of one URL, while a
+# condensed report is a record per repository followed by the failing URLs.
+def jsonl_records(results):
+	if set(results.keys()) == {"repos", "urls"}:
+		for repo, status in results["repos"].items():
+			yield {"repo": repo, "status": status}
+		results = results["urls"]
+	for url in sorted(results.keys()):
+		yield dict(results[url], url=url)
+
+
+def write_jsonl(jsonl_file, results):
+	with open(jsonl_file, "w") as outfile:
+		for record in jsonl_records(results):
+			outfile.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def read_jsonl(jsonl_file):
+	with open(jsonl_file, "r") as in_file:
+		for line in in_file:
+			if line.strip():
+				yield json.loads(line)
+
+
+def is_jsonl_record(line):
+	try:
+		record = json.loads(line)
+	except ValueError:
+		return False
+	return isinstance(record, dict) and ("url" in record or "repo" in record)
+
+
+# an empty file, e.g.: the results of a run without URLs, is JSON Lines
+# without records, as it is not valid JSON
+def is_jsonl_file(path):
+	with open(path, "r") as in_file:
+		for line in in_file:
+			if line.strip():
+				return is_jsonl_record(line)
+	return True
+
+
+# written to the side, then moved in to place, so that if the run is
+# stopped while writing, the previous results are not lost
+def write_results(path, results, results_format="json"):
+	tmp_path = path + ".tmp"
+	if results_format == "jsonl":
+		write_jsonl(tmp_path, results)
+	else:
+		write_json(tmp_path, results)
+	os.replace(tmp_path, path)
+
+
+# reads either format, so the format can change between runs
+def read_results(path):
+	if not os.path.exists(path) or not is_jsonl_file(path):
+		return read_json(path)
+	repos = {}
+	urls = {}
+	for record in read_jsonl(path):
+		if "url" in record:
+			urls[record["url"]] = record
+		else:
+			repos[record["repo"]] = record["status"]
+	if repos:
+		return {"repos": repos, "urls": urls}
+	return urls
+
+
+def is_sqlite_path(path):
+	return os.path.splitext(path)[1] in [".db", ".sqlite", ".sqlite3"]
+
+
+# the most recent time in the check, and the status at that time
+def last_checked(check):
+	if check.get("status") == 200:
+		return check.get("200")
+	fail = check.get("fail", {})
+	return fail.get("to", fail.get("from"))
+
+
+# An alternative to the results JSON file, for large sets of results:
+#	"urls": each URL with the JSON of its entry, less the "used"
+#	"usages": the repository files in which each URL is used
+#	"history": the time and status of every check of each URL
+# Saving only writes the rows which differ from those loaded,
+# rather than serializing all of the results.
+class Sqlite_Store:
+
+	schema = [
+			"CREATE TABLE IF NOT EXISTS urls"
+			" (url TEXT PRIMARY KEY, data TEXT NOT NULL)",
+			"CREATE TABLE IF NOT EXISTS usages"
+			" (url TEXT NOT NULL, repo TEXT NOT NULL, file TEXT NOT NULL,"
+			" PRIMARY KEY (url, repo, file))",
+			"CREATE INDEX IF NOT EXISTS usages_by_repo ON usages (repo, url)",
+			"CREATE TABLE IF NOT EXISTS history"
+			" (url TEXT NOT NULL, checked TEXT NOT NULL, status INTEGER)",
+			"CREATE INDEX IF NOT EXISTS history_by_url ON history (url, checked)",
+	]
+
+	def __init__(self, path):
+		self.path = path
+		self.loaded = {}
+
+	def connect(self):
+		db = sqlite3.connect(self.path)
+		for statement in self.schema:
+			db.execute(statement)
+		return db
+
+	@staticmethod
+	def row_data(entry):
+		data = {key: val for key, val in entry.items() if key != "used"}
+		return json.dumps(data, sort_keys=True)
+
+	@staticmethod
+	def row_usages(entry):
+		usages = set()
+		for repo, files in entry.get("used", {}).items():
+			for file in files:
+				usages.add((repo, file))
+		return usages
+
+	def load(self):
+		checks = {}
+		db = self.connect()
+		with db:
+			for url, data in db.execute("SELECT url, data FROM urls ORDER BY url"):
+				checks[url] = json.loads(data)
+				checks[url]["used"] = {}
+			query = "SELECT url, repo, file FROM usages ORDER BY url, repo, file"
+			for url, repo, file in db.execute(query):
+				checks[url]["used"].setdefault(repo, []).append(file)
+		db.close()
+		for url, entry in checks.items():
+			self.loaded[url] = (self.row_data(entry), self.row_usages(entry))
+		return checks
+
+	def save(self, checks):
+		db = self.connect()
+		with db:
+			for url, entry in checks.items():
+				data = self.row_data(entry)
+				usages = self.row_usages(entry)
+				old_data, old_usages = self.loaded.get(url, (None, set()))
+				if data != old_data:
+					db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, data))
+					when = last_checked(entry.get("checks", {}))
+					old_when = None
+					if old_data:
+						old_when = last_checked(json.loads(old_data).get("checks", {}))
+					if when and when != old_when:
+						status = entry["checks"].get("status")
+						db.execute("INSERT INTO history VALUES (?, ?, ?)",
+								(url, when, status))
+				for repo, file in old_usages - usages:
+					db.execute(
+							"DELETE FROM usages WHERE url = ? AND repo = ? AND file = ?",
+							(url, repo, file))
+				for repo, file in usages - old_usages:
+					db.execute("INSERT INTO usages VALUES (?, ?, ?)", (url, repo, file))
+				self.loaded[url] = (data, usages)
+			for url in set(self.loaded.keys()) - set(checks.keys()):
+				db.execute("DELETE FROM urls WHERE url = ?", (url,))
+				db.execute("DELETE FROM usages WHERE url = ?", (url,))
+				self.loaded.pop(url)
+		db.close()
+
+
 # spawn a shell to run the commmand(s),
 # returns the text which would have been output to the screen
-def shell_slurp(cmd_str, working_dir=os.getcwd(), ctx=None, fail_func=None):
+# if input_text is provided, it is sent to the command's stdin
+def shell_slurp(cmd_str,
+		working_dir=os.getcwd(),
+		ctx=None,
+		fail_func=None,
+		input_text=None):
 	ctx = ensure_context(ctx)
 	ctx.debug(f"working_dir={working_dir}")
 	ctx.debug(cmd_str)
+	if input_text is not None:
+		input_text = input_text.encode("utf-8")
 	result = subprocess.run(
 			cmd_str,
 			shell=True,
+			input=input_text,
 			stdout=subprocess.PIPE,
 			stderr=subprocess.STDOUT,
 			cwd=working_dir,
@@ -97,78 +378,508 @@ def files_from_repo(repos_basedir, repo_name, repo_url, branch, ctx=None):
 	cmd = f"mkdir -pv {repos_basedir}"
 	shell_slurp(cmd, os.getcwd(), ctx)
 
-	cmd = f"git clone {repo_url} {repo_name}"
+	# only the latest commit of the branch is needed
+	cmd = f"git clone --depth=1 --single-branch --branch={branch}"
+	cmd += f" {repo_url} {repo_name}"
 	shell_slurp(cmd, repos_basedir, ctx)
 	repo_dir = os.path.join(repos_basedir, repo_name)
 
-	cmd = f"git switch {branch}"
+	cmd = "git fetch --depth=1 origin"
+	cmd += f" +refs/heads/{branch}:refs/remotes/origin/{branch}"
 	shell_slurp(cmd, repo_dir, ctx)
 
-	cmd = f"git fetch --all"
+	cmd = f"git checkout --force -B {branch} origin/{branch}"
 	shell_slurp(cmd, repo_dir, ctx)
 
-	cmd = f"git reset --hard origin/{branch}"
-	shell_slurp(cmd, repo_dir, ctx)
-
-	cmd = f"git ls-tree -r --name-only {branch}"
+	# do not quote the names of files with unusual characters
+	cmd = f"git -c core.quotePath=false ls-tree -r --name-only {branch}"
 	files = shell_slurp(cmd, repo_dir, ctx).splitlines()
 
 	return files
 
 
-def urls_from(workdir, file, transforms, user_ignore_patterns=[], ctx=None):
+def bare_repo_dir(repos_basedir, repo_name):
+	return os.path.join(repos_basedir, repo_name + ".git")
+
+
+# Rather than checking out a working tree, keep a bare clone and
+# return a dict of the file names to the git blob IDs of their contents
+def blobs_from_repo(repos_basedir, repo_name, repo_url, branch, ctx=None):
+
+	cmd = f"mkdir -pv {repos_basedir}"
+	shell_slurp(cmd, os.getcwd(), ctx)
+
+	# only the latest commit of the branch is needed, and without the
+	# blobs, which are fetched when needed by prefetch_blobs
+	cmd = f"git clone --bare --depth=1 --single-branch --branch={branch}"
+	cmd += f" --filter=blob:none {repo_url} {repo_name}.git"
+	shell_slurp(cmd, repos_basedir, ctx)
+	repo_dir = bare_repo_dir(repos_basedir, repo_name)
+
+	cmd = f"git fetch --depth=1 origin +refs/heads/{branch}:refs/heads/{branch}"
+	shell_slurp(cmd, repo_dir, ctx)
+
+	return tree_blobs(repo_dir, branch, ctx)
+
+
+# a dict of the file names in the tree of the branch to their blob IDs
+def tree_blobs(repo_dir, branch, ctx=None):
+	# each entry is "<mode> <type> <object>\t<file>", NUL terminated
+	cmd = f"git -c core.quotePath=false ls-tree -r -z {branch}"
+	entries = shell_slurp(cmd, repo_dir, ctx).split("\0")
+
+	blobs = {}
+	for entry in entries:
+		info, _, file = entry.partition("\t")
+		info = info.split()
+		# skip submodules, which are "commit" entries
+		if len(info) == 3 and info[1] == "blob":
+			blobs[file] = info[2]
+
+	return blobs
+
+
+# Several branches of a repository share a single bare clone, all of the
+# branches are fetched at once, and a dict of each branch to the dict of
+# its files to their blob IDs is returned; the files which are the same in
+# many branches have the same blob, which is only fetched and read once.
+def branches_blobs_from_repo(repos_basedir,
+		repo_name,
+		repo_url,
+		branches,
+		ctx=None):
+
+	cmd = f"mkdir -pv {repos_basedir}"
+	shell_slurp(cmd, os.getcwd(), ctx)
+
+	cmd = f"git clone --bare --depth=1 --single-branch --branch={branches[0]}"
+	cmd += f" --filter=blob:none {repo_url} {repo_name}.git"
+	shell_slurp(cmd, repos_basedir, ctx)
+	repo_dir = bare_repo_dir(repos_basedir, repo_name)
+
+	cmd = "git fetch --depth=1 origin"
+	for branch in branches:
+		cmd += f" +refs/heads/{branch}:refs/heads/{branch}"
+	shell_slurp(cmd, repo_dir, ctx)
+
+	return {branch: tree_blobs(repo_dir, branch, ctx) for branch in branches}
+
+
+# the usages of the files of a repository with "branches" in the config are
+# noted with the branch, as in "git show <branch>:<file>"
+def branch_file(branch, file):
+	return f"{branch}:{file}"
+
+
+def repo_commit(repo_dir, branch, ctx=None):
+	return shell_slurp(f"git rev-parse {branch}", repo_dir, ctx)
+
+
+# the files which differ between the commits, as a dict of the file name to
+# the status letter, "A", "M", "D", etc., or None if the diff failed,
+# e.g.: the old commit is not in the repository. As renames are not looked
+# for, the contents are not needed, only the trees, as in a blobless clone.
+def changed_files(repo_dir, old_commit, new_commit, ctx=None):
+	cmd = "git -c core.quotePath=false diff --no-renames --name-status -z"
+	cmd += f" {old_commit} {new_commit}"
+	text = shell_slurp(cmd, repo_dir, ctx, fail_func=lambda result: None)
+	if text is None:
+		return None
+	fields = text.split("\0")
+	changed = {}
+	for status, file in zip(fields[0::2], fields[1::2]):
+		changed[file] = status
+	return changed
+
 
-	# pull URLs out of the file, including option leading paren
-	# TODO: Regex does not fully conform to RFC 3986 URI Generic Syntax.
-	#	Some valid characters are only valid in parts of the URI.
-	#	Some valid characters are not matched by the current regex
-	# Note: Single quote escaping is hard to read, in a bash single quoted
-	#	string, the sequence {'"'"'} becomes {'} by:
-	#	* ending the single-quoted string
-	#	* starting a double-quoted string
-	#	* having a single quote inside the double quotes
-	#	* ending the double-quoted string
-	#	* starting a new single-quoted string
-	#	Below, the single quotes need to be escaped by python:
-	url_pattern = 'http[s]?://[^[:space:]<>"`\'"\'"\']+'
-	cmd_str = f"grep --extended-regexp --only-matching --text \
-		'[\\(]?{url_pattern}' \
-		'{file}'"
-
-	for transform in transforms:
-		cmd_str = cmd_str + f" | {transform}"
-
-	# remove surrounding parens if they exist
-	cmd_str += " | sed -e 's/^(http\\(.*\\))[\\.,]\\?$/http\\1/g'"
-
-	# de-duplicate
-	cmd_str += " | sort --unique"
-
-	# print("\n", cmd_str, "\n")
-
-	ignore_patterns = [
-			'^http[s]\?://localhost',
-			'^http[s]\?://127.0.0.1',
-			'^http[s]\?://web.archive.org',
+# for an incremental run, the files changed since the commit of the last
+# run, or None if all of the files need to be extracted
+def changed_files_for(gits_dir, name, ctx):
+	old_commit = ctx.previous_commits.get(name)
+	new_commit = (ctx.repo_commits or {}).get(name)
+	if not (old_commit and new_commit):
+		return None
+	if old_commit == new_commit:
+		return {}
+	if isinstance(new_commit, dict):
+		return changed_branches_files(
+				bare_repo_dir(gits_dir, name), old_commit, new_commit, ctx)
+	# the repository had "branches" in the last run
+	if not isinstance(old_commit, str):
+		return None
+	repo_dir = os.path.join(gits_dir, name)
+	if ctx.extract == "blobs":
+		repo_dir = bare_repo_dir(gits_dir, name)
+	return changed_files(repo_dir, old_commit, new_commit, ctx)
+
+
+# for a repository with "branches", the commits are a dict of each branch
+# to its commit, a branch which was not in the last run is extracted in full
+def changed_branches_files(repo_dir, old_commits, new_commits, ctx):
+	if not isinstance(old_commits, dict):
+		return None
+	changed = {}
+	for branch, new_commit in new_commits.items():
+		old_commit = old_commits.get(branch)
+		if not old_commit:
+			return None
+		if old_commit == new_commit:
+			continue
+		branch_changed = changed_files(repo_dir, old_commit, new_commit, ctx)
+		if branch_changed is None:
+			return None
+		for file, status in branch_changed.items():
+			changed[branch_file(branch, file)] = status
+	return changed
+
+
+# In a blobless clone, reading a missing blob would fetch it on its own,
+# thus fetch all of the missing blobs that are needed in a single request
+def prefetch_blobs(repo_dir, blobs, ctx=None):
+	if not blobs:
+		return
+	cmd = "git cat-file --batch-all-objects --batch-check='%(objectname)'"
+	present = set(shell_slurp(cmd, repo_dir, ctx).split())
+	missing = sorted(set(blobs) - present)
+	if not missing:
+		return
+	cmd = "git -c fetch.negotiationAlgorithm=noop fetch origin --stdin"
+	cmd += " --no-tags --no-write-fetch-head --recurse-submodules=no"
+	cmd += " --filter=blob:none"
+	shell_slurp(cmd, repo_dir, ctx, input_text="\n".join(missing) + "\n")
+
+
+# A single long-running "git cat-file --batch" process for a repository,
+# so that reading each blob does not spawn a process.
+class Git_Blob_Reader:
+
+	def __init__(self, repo_dir, ctx=None):
+		self.ctx = ensure_context(ctx)
+		self.repo_dir = repo_dir
+		self.ctx.debug(f"working_dir={repo_dir}")
+		self.ctx.debug("git cat-file --batch")
+		self.process = subprocess.Popen(
+				["git", "cat-file", "--batch"],
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				cwd=repo_dir,
+		)
+
+	# returns the contents of the blob, or None if it is not a blob
+	def read(self, blob):
+		self.process.stdin.write(blob.encode("utf-8") + b"\n")
+		self.process.stdin.flush()
+		# "<object> <type> <size>\n<contents>\n" or "<object> missing\n"
+		header = self.process.stdout.readline().split()
+		if len(header) != 3 or header[1] != b"blob":
+			self.ctx.debug({'blob': blob, 'error': header})
+			return None
+		data = self.process.stdout.read(int(header[2]))
+		self.process.stdout.read(1)
+		return data
+
+	def close(self):
+		self.process.stdin.close()
+		self.process.wait()
+		self.process.stdout.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+# pull URLs out of the text, including optional leading paren
+# TODO: Regex does not fully conform to RFC 3986 URI Generic Syntax.
+#	Some valid characters are only valid in parts of the URI.
+#	Some valid characters are not matched by the current regex
+url_regex = re.compile(rb"\(?https?://[^\s<>\"`']+")
+
+# remove surrounding parens if they exist
+paren_regex = re.compile(r"^\(http(.*)\)[.,]?$")
+
+default_ignore_patterns = [
+		'^http[s]\\?://localhost',
+		'^http[s]\\?://127.0.0.1',
+		'^http[s]\\?://web.archive.org',
+]
+
+posix_classes = {
+		"[:alnum:]": "0-9A-Za-z",
+		"[:alpha:]": "A-Za-z",
+		"[:blank:]": " \\t",
+		"[:digit:]": "0-9",
+		"[:lower:]": "a-z",
+		"[:space:]": "\\s",
+		"[:upper:]": "A-Z",
+		"[:xdigit:]": "0-9A-Fa-f",
+}
+
+
+# The ignore patterns in the config are written for "grep" basic regular
+# expressions (BRE), where "?", "+", "|", "{", "}", "(" and ")" are literal
+# unless escaped with a backslash; python regular expressions are the other
+# way around, thus swap the escaping of those characters.
+# Within a bracket expression a backslash is literal, and the POSIX
+# character classes are replaced with the python equivalent.
+def regex_from_grep_pattern(pattern):
+	regex = ""
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if c == "\\" and i + 1 < len(pattern):
+			c = pattern[i + 1]
+			i += 2
+			if c in "?+|{}()":
+				regex += c
+			elif c in "<>":
+				regex += "\\b"
+			else:
+				regex += "\\" + c
+			continue
+		if c in "?+|{}()":
+			regex += "\\" + c
+			i += 1
+			continue
+		if c != "[":
+			regex += c
+			i += 1
+			continue
+		# bracket expression, a leading "^" negates,
+		# a "]" directly after the opening (or negation) is literal
+		regex += "["
+		i += 1
+		if pattern[i:i + 1] == "^":
+			regex += "^"
+			i += 1
+		if pattern[i:i + 1] == "]":
+			regex += "\\]"
+			i += 1
+		while i < len(pattern) and pattern[i] != "]":
+			end = pattern.find(":]", i)
+			if pattern.startswith("[:", i) and end > i:
+				posix = pattern[i:end + 2]
+				regex += posix_classes.get(posix, "")
+				i += len(posix)
+				continue
+			c = pattern[i]
+			if c in "\\[&~|":
+				regex += "\\"
+			regex += c
+			i += 1
+		regex += "]"
+		i += 1
+	return regex
+
+
+# combine the grep patterns (e.g.: all of the ignore patterns) in to a
+# single precompiled regex, cached as the same patterns are used for
+# every file
+@functools.lru_cache(maxsize=None)
+def grep_patterns_regex(patterns):
+	regexes = [regex_from_grep_pattern(pattern) for pattern in patterns]
+	return re.compile("|".join(f"(?:{regex})" for regex in regexes))
+
+
+def url_matches(data):
+	return [
+			match.decode("utf-8", errors="replace")
+			for match in url_regex.findall(data)
 	]
-	ignore_patterns.extend(user_ignore_patterns)
 
-	for pattern in ignore_patterns:
-		cmd_str += f" | grep --invert-match '{pattern}'"
 
-	lines = shell_slurp(cmd_str, workdir, ctx).splitlines()
-	urls = []
+# the transforms are shell filters (e.g.: "sed"), thus only spawn
+# a shell if there are transforms and something for them to transform
+def transform_lines(lines, transforms, workdir=os.getcwd(), ctx=None):
+	if not (transforms and lines):
+		return lines
+	cmd_str = " | ".join(transforms)
+	text = "\n".join(lines) + "\n"
+	return shell_slurp(cmd_str, workdir, ctx, input_text=text).splitlines()
+
+
+def urls_from_lines(lines,
+		transforms,
+		user_ignore_patterns=[],
+		workdir=os.getcwd(),
+		ctx=None):
+	lines = transform_lines(lines, transforms, workdir, ctx)
+
+	ignore_patterns = list(default_ignore_patterns)
+	ignore_patterns.extend(user_ignore_patterns)
+	ignore = grep_patterns_regex(tuple(ignore_patterns))
+
+	urls = set()
 	for line in lines:
+		line = paren_regex.sub(r"http\1", line)
+		if ignore.search(line):
+			continue
 		if line.startswith("(http"):
 			# In the case of a named anchor,
 			# the trailing parenthesis is missing,
 			# for now, just chop-off leading parenthesis.
 			line = line[1:]
-		# ignore 'binary file matches' messages, only grab URLs
+		# ignore anything mangled by a transform, only grab URLs
 		if line.startswith("http"):
-			urls += [line]
+			urls.add(line)
 
-	return urls
+	return sorted(urls)
+
+
+def urls_from_bytes(data,
+		transforms,
+		user_ignore_patterns=[],
+		workdir=os.getcwd(),
+		ctx=None):
+	lines = url_matches(data)
+	return urls_from_lines(lines, transforms, user_ignore_patterns, workdir, ctx)
+
+
+def file_bytes(workdir, file, ctx=None):
+	try:
+		with open(os.path.join(workdir, file), "rb") as in_file:
+			return in_file.read()
+	except OSError as e:
+		# e.g.: a submodule is a directory
+		ctx = ensure_context(ctx)
+		ctx.debug({'file': file, 'error': e})
+		return b""
+
+
+def urls_from(workdir, file, transforms, user_ignore_patterns=[], ctx=None):
+	data = file_bytes(workdir, file, ctx)
+	return urls_from_bytes(data, transforms, user_ignore_patterns, workdir, ctx)
+
+
+# the same ID as "git hash-object" would give for the file contents
+def git_blob_id(data):
+	header = f"blob {len(data)}\0".encode("utf-8")
+	return hashlib.sha1(header + data).hexdigest()
+
+
+# Any change to how URLs are extracted must give a different hash,
+# thus the hash includes the URL regex as well as the ignore patterns
+# and the transforms
+@functools.lru_cache(maxsize=None)
+def extract_settings_hash(ignore_patterns, transforms):
+	settings = [
+			url_regex.pattern.decode("utf-8"),
+			paren_regex.pattern,
+			default_ignore_patterns,
+			list(ignore_patterns),
+			list(transforms),
+	]
+	return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()
+
+
+# The URLs found in each git blob, keyed by the extraction settings hash
+# and the blob ID, persisted between runs so unchanged files are not scanned.
+# Only the entries used in this run are saved, thus the cache does not grow
+# with every version of every file.
+class Extract_Cache:
+
+	def __init__(self, path=None):
+		self.path = path
+		self.cached = read_json(path) if path else {}
+		self.used = {}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, blob, ignore_patterns, transforms):
+		key = extract_settings_hash(tuple(ignore_patterns), tuple(transforms))
+		urls = self.used.get(key, {}).get(blob)
+		if urls is None:
+			urls = self.cached.get(key, {}).get(blob)
+		if urls is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.used.setdefault(key, {})[blob] = urls
+		return urls
+
+	def contains(self, blob, ignore_patterns, transforms):
+		key = extract_settings_hash(tuple(ignore_patterns), tuple(transforms))
+		return (blob in self.used.get(key, {})) or (blob in self.cached.get(
+				key, {}))
+
+	def put(self, blob, ignore_patterns, transforms, urls):
+		key = extract_settings_hash(tuple(ignore_patterns), tuple(transforms))
+		self.used.setdefault(key, {})[blob] = urls
+
+	def save(self):
+		if self.path:
+			write_json(self.path, self.used)
+
+	# for a long running process, the entries used in this run become
+	# the cache of the next, rather than reading the saved cache again
+	def next_run(self):
+		self.cached = self.used
+		self.used = {}
+
+
+# The same pattern as url_regex, as a POSIX extended regular expression
+git_grep_url_pattern = '[(]?https?://[^[:space:]<>"`\']+'
+
+
+# Search every file in the repository HEAD with a single "git grep", rather
+# than scanning file-by-file, returns a dict of file to URLs, limited to the
+# files given, or None if the search could not be performed.
+def urls_by_file_from_git_grep(repo_dir,
+		files,
+		transforms,
+		user_ignore_patterns=[],
+		ctx=None):
+	ctx = ensure_context(ctx)
+	if not os.path.exists(os.path.join(repo_dir, ".git")):
+		ctx.debug(f"not a git working tree: {repo_dir}")
+		return None
+
+	cmd = [
+			"git", "grep", "--only-matching", "-I", "--extended-regexp", "--null",
+			"--no-color", "-e", git_grep_url_pattern, "HEAD"
+	]
+	ctx.debug(f"working_dir={repo_dir}")
+	ctx.debug(cmd)
+	result = subprocess.run(
+			cmd,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			cwd=repo_dir,
+	)
+	ctx.debug(f"return code: {result.returncode}")
+	# git grep returns 1 when there are no matches
+	if result.returncode > 1:
+		ctx.log(repo_dir, result.stderr.decode("utf-8", errors="replace"))
+		return None
+
+	wanted = set(files)
+	file_lines = {}
+	for record in result.stdout.splitlines():
+		# records are "HEAD:path\0match"
+		path, _, match = record.partition(b"\0")
+		file = path.decode("utf-8", errors="replace").partition(":")[2]
+		if file in wanted:
+			line = match.decode("utf-8", errors="replace")
+			file_lines.setdefault(file, []).append(line)
+
+	# The transforms are line filters, so send all distinct matches through
+	# the transforms at once; if a transform adds or removes lines, then
+	# the output can not be mapped back, so transform each file separately.
+	if transforms and file_lines:
+		distinct = sorted({l for lines in file_lines.values() for l in lines})
+		transformed = transform_lines(distinct, transforms, repo_dir, ctx)
+		if len(transformed) == len(distinct):
+			mapping = dict(zip(distinct, transformed))
+			for file, lines in file_lines.items():
+				file_lines[file] = [mapping[line] for line in lines]
+			transforms = []
+
+	file_urls = {}
+	for file, lines in file_lines.items():
+		file_urls[file] = urls_from_lines(lines, transforms, user_ignore_patterns,
+				repo_dir, ctx)
+	return file_urls
 
 
 def clear_previous_used(checks, name):
@@ -178,10 +889,7 @@ def clear_previous_used(checks, name):
 			checks[url]["used"][name] = []
 
 
-def set_used_for_file(
-		checks, gits_dir, name, file, ignore_patterns, transforms, ctx):
-	repo_dir = os.path.join(gits_dir, name)
-	urls = urls_from(repo_dir, file, transforms, ignore_patterns, ctx)
+def add_used(checks, name, file, urls):
 	for url in urls:
 		if url not in checks.keys():
 			checks[url] = {}
@@ -194,13 +902,116 @@ def set_used_for_file(
 			checks[url]["used"][name] += [file]
 
 
+def set_used_for_file(checks,
+		gits_dir,
+		name,
+		file,
+		ignore_patterns,
+		transforms,
+		ctx,
+		blob=None,
+		reader=None):
+	urls = urls_for_file(gits_dir, name, file, ignore_patterns, transforms, ctx,
+			blob, reader)
+	add_used(checks, name, file, urls)
+
+
+# if a reader is provided, the contents of the file are read from
+# the blob rather than the working tree,
+# if the context has an extract_cache, the URLs of a blob are only
+# extracted if they are not in the cache
+def urls_for_file(gits_dir,
+		name,
+		file,
+		ignore_patterns,
+		transforms,
+		ctx,
+		blob=None,
+		reader=None):
+	cache = ctx.extract_cache
+	data = None
+	if reader:
+		workdir = reader.repo_dir
+	else:
+		workdir = os.path.join(gits_dir, name)
+		data = file_bytes(workdir, file, ctx)
+		if cache is not None:
+			blob = git_blob_id(data)
+
+	urls = None
+	if cache is not None:
+		urls = cache.get(blob, ignore_patterns, transforms)
+	if urls is None:
+		if data is None:
+			data = reader.read(blob) or b""
+		urls = urls_from_bytes(data, transforms, ignore_patterns, workdir, ctx)
+		if cache is not None:
+			cache.put(blob, ignore_patterns, transforms, urls)
+	return urls
+
+
 def set_used(checks, gits_dir, name, files, ignore_patterns, transforms, ctx):
 	clear_previous_used(checks, name)
+	add_used_for_files(checks, gits_dir, name, files, ignore_patterns, transforms,
+			ctx)
+
+
+def add_used_for_files(
+		checks, gits_dir, name, files, ignore_patterns, transforms, ctx):
+	# the files are a dict of the file name to the blob ID when read from
+	# the object store, each distinct blob is only read once
+	if isinstance(files, dict):
+		repo_dir = bare_repo_dir(gits_dir, name)
+		cache = ctx.extract_cache
+		files_by_blob = {}
+		for file, blob in files.items():
+			files_by_blob.setdefault(blob, []).append(file)
+		needed = [
+				blob for blob in files_by_blob.keys() if cache is None or
+				not cache.contains(blob, ignore_patterns, transforms)
+		]
+		prefetch_blobs(repo_dir, needed, ctx)
+		with Git_Blob_Reader(repo_dir, ctx) as reader:
+			for blob, blob_files in files_by_blob.items():
+				urls = urls_for_file(gits_dir, name, blob_files[0], ignore_patterns,
+						transforms, ctx, blob, reader)
+				for file in blob_files:
+					add_used(checks, name, file, urls)
+		return
+	if ctx.extract == "git-grep":
+		repo_dir = os.path.join(gits_dir, name)
+		file_urls = urls_by_file_from_git_grep(repo_dir, files, transforms,
+				ignore_patterns, ctx)
+		if file_urls is not None:
+			for file, urls in file_urls.items():
+				add_used(checks, name, file, urls)
+			return
 	for file in files:
 		set_used_for_file(checks, gits_dir, name, file, ignore_patterns, transforms,
 				ctx)
 
 
+# Rather than extracting the URLs of every file, only the changed files are
+# extracted again, the usages of the other files are kept, except for
+# files which are no longer in the repository, or are now ignored.
+def update_used(
+		checks, gits_dir, name, files, changed, ignore_patterns, transforms, ctx):
+	present = set(files)
+	for url in checks.keys():
+		used = checks[url]["used"]
+		if name in used:
+			used[name] = [
+					file for file in used[name] if file in present and file not in changed
+			]
+	if isinstance(files, dict):
+		changed_files = {file: files[file] for file in files if file in changed}
+	else:
+		changed_files = [file for file in files if file in changed]
+	ctx.log(name, "has", len(changed_files), "changed files")
+	add_used_for_files(checks, gits_dir, name, changed_files, ignore_patterns,
+			transforms, ctx)
+
+
 def remove_unused(checks):
 	unused = []
 	for url in checks.keys():
@@ -232,7 +1043,250 @@ def sort_by_key(stuff):
 	return {key: val for key, val in sorted_elems}
 
 
-def status_code_for_url(url, timeout, ctx=None):
+# text extracted from files is not always a valid URL,
+# for those, the host is the empty string
+def host_of_url(url):
+	try:
+		return urllib.parse.urlsplit(url).hostname or ""
+	except ValueError:
+		return ""
+
+
+# One requests.Session per host, each keeping up to pool_size connections
+# open, so that the URLs of a host are checked over a few warm connections,
+# rather than a new TCP connection and TLS handshake for every URL.
+# The adapter of a session keeps the pools of a few schemes and hosts,
+# so that a redirect from "http://" to "https://", or to another host,
+# does not evict the pool of the host.
+class Session_Pool:
+
+	pool_connections = 4
+
+	def __init__(self, pool_size=4, retries=0, keep_alive=True):
+		self.pool_size = pool_size
+		self.retries = retries
+		self.keep_alive = keep_alive
+		self.sessions = {}
+		self.lock = threading.Lock()
+
+	def new_session(self):
+		session = requests.Session()
+		retry = requests.adapters.Retry(total=self.retries, backoff_factor=0.5)
+		adapter = requests.adapters.HTTPAdapter(
+				pool_connections=self.pool_connections,
+				pool_maxsize=self.pool_size,
+				max_retries=retry)
+		session.mount("http://", adapter)
+		session.mount("https://", adapter)
+		if not self.keep_alive:
+			session.headers["Connection"] = "close"
+		return session
+
+	def session_for(self, url):
+		host = host_of_url(url)
+		with self.lock:
+			if host not in self.sessions:
+				self.sessions[host] = self.new_session()
+			return self.sessions[host]
+
+	def close(self):
+		with self.lock:
+			for session in self.sessions.values():
+				session.close()
+			self.sessions = {}
+
+
+# the resolver answers which mean that there is no such host
+# (or that it has no address), rather than that the lookup failed
+no_such_host_errors = [
+		socket.EAI_NONAME,
+		getattr(socket, "EAI_NODATA", socket.EAI_NONAME),
+]
+
+
+# returns the addresses of the host, None if there is no such host,
+# or an empty list if the lookup failed for some other reason
+def resolve_host(host, ctx):
+	try:
+		return sorted(set(ctx.resolve(host)))
+	except socket.gaierror as e:
+		if e.errno in no_such_host_errors:
+			return None
+		ctx.debug({'host': host, 'error': e})
+		return []
+
+
+# Before any URL is checked, the hosts of the URLs are all looked up at
+# once, ctx.concurrency at a time, and the answers kept in ctx.dns_cache
+# for the run, so that the URLs of hosts which do not exist fail without
+# a request. The addresses are only used to tell that a host exists, the
+# requests of the checks look up their hosts as usual.
+# Lookups which fail for other reasons are not cached, those URLs are
+# checked as usual.
+def resolve_hosts(urls, ctx):
+	hosts = sorted({host_of_url(url) for url in urls} - {""})
+	hosts = [host for host in hosts if host not in ctx.dns_cache]
+	max_workers = max(1, ctx.concurrency)
+	with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+		resolve = profiled(lambda host: resolve_host(host, ctx), ctx)
+		answers = executor.map(resolve, hosts)
+		for host, addresses in zip(hosts, answers):
+			if addresses != []:
+				ctx.dns_cache[host] = addresses
+	missing = [host for host in hosts if ctx.dns_cache.get(host, []) is None]
+	ctx.log("resolved", len(hosts), "hosts,", len(missing), "do not exist")
+	ctx.debug(missing)
+	return missing
+
+
+def is_no_such_host(host, ctx):
+	return ctx.dns_cache is not None and ctx.dns_cache.get(host, []) is None
+
+
+# After ctx.breaker.threshold consecutive timeouts or connection errors on a
+# host, the host is taken to be down, and the remaining URLs of the host are
+# not checked, but fail at once with the circuit_open_status, rather than
+# each waiting for the full timeout.
+circuit_open_status = -2
+
+
+class Circuit_Breaker:
+
+	def __init__(self, threshold=5):
+		self.threshold = threshold
+		self.errors = {}
+		self.lock = threading.Lock()
+
+	def is_open(self, host):
+		with self.lock:
+			errors = self.errors.get(host, 0)
+			return self.threshold > 0 and errors >= self.threshold
+
+	def record(self, host, ok):
+		with self.lock:
+			if ok:
+				self.errors[host] = 0
+			else:
+				self.errors[host] = self.errors.get(host, 0) + 1
+
+
+# the same limit as requests uses
+max_redirects = 30
+
+# A busy server may ask to be tried again later, rather than fail at once,
+# the URL is checked again after the "Retry-After", up to this many times,
+# waiting at most ctx.max_retry_after seconds each time
+retry_after_codes = [429, 503]
+retry_after_tries = 2
+
+
+# the "Retry-After" header is either seconds or an HTTP date,
+# returns None if there is no valid header
+def retry_after_seconds(response):
+	value = response.headers.get("Retry-After", "").strip()
+	if value.isdigit():
+		return int(value)
+	try:
+		when = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	if when.tzinfo is None:
+		when = when.replace(tzinfo=datetime.timezone.utc)
+	now = datetime.datetime.now(datetime.timezone.utc)
+	return max(0, (when - now).total_seconds())
+
+
+# Many servers reject HEAD requests for pages which are fine
+head_rejected_codes = [400, 403, 404, 405, 501]
+
+# A ranged GET for the first byte succeeds with a 206, or if the page is
+# empty, a 416, either way the page is there
+ranged_get_ok_codes = [206, 416]
+
+
+# From the "strategies" of the config, the strategy of the first pattern
+# which matches the URL, e.g.:
+#	"strategies": {
+#		"^https://www\\.linkedin\\.com/": "get",
+#		"^https://example\\.org/": "head"
+#	}
+# "head" only sends a HEAD request, "get" only a ranged GET, and the
+# default, "head-then-get", sends a ranged GET if the HEAD is rejected.
+def check_strategy(url, strategies):
+	for pattern, strategy in strategies.items():
+		if grep_patterns_regex((pattern,)).search(url):
+			return strategy
+	return "head-then-get"
+
+
+# If the context has a deadline, a check which would run past it is stopped,
+# whether a request, a wait for a "Retry-After", or the next redirect hop.
+class Deadline_Passed(Exception):
+	pass
+
+
+# whether the deadline has passed, or will have, after the wait
+def deadline_passed(ctx, wait=0):
+	return ctx.deadline is not None and ctx.monotonic() + wait >= ctx.deadline
+
+
+# the timeout of a request, cut short so as not to run past the deadline
+def request_timeout(timeout, ctx):
+	if ctx.deadline is None:
+		return timeout
+	remaining = ctx.deadline - ctx.monotonic()
+	if remaining <= 0:
+		raise Deadline_Passed()
+	return min(timeout, remaining)
+
+
+# Rather than a GET which would download the whole page, a GET which only
+# asks for the first byte, streamed so that only the headers are read.
+# If the server sent the single byte, it is read, so that the connection
+# can be reused, otherwise the connection is closed without reading the body.
+def request_url(http, url, timeout, headers, ctx):
+	strategy = check_strategy(url, ctx.strategies)
+	if strategy != "get":
+		response = http.head(
+				url,
+				allow_redirects=False,
+				timeout=request_timeout(timeout, ctx),
+				headers=headers)
+		if strategy == "head" or response.status_code not in head_rejected_codes:
+			return response
+		ctx.debug({'url': url, 'HEAD': response.status_code})
+
+	ranged = dict(headers)
+	ranged["Range"] = "bytes=0-0"
+	response = http.get(
+			url,
+			allow_redirects=False,
+			timeout=request_timeout(timeout, ctx),
+			headers=ranged,
+			stream=True)
+	if response.status_code == 206:
+		# reading the content marks it consumed, so the close below returns
+		# the connection to the pool, rather than closing it
+		_ = response.content
+	response.close()
+	if response.status_code in ranged_get_ok_codes:
+		response.status_code = 200
+	return response
+
+
+# Redirects are followed one hop at a time, so that the chain can be
+# recorded, and, if the context has a redirect_cache, so that a hop
+# already seen in this run is not fetched again, e.g.: the many links to
+# "http://" pages which redirect to "https://".
+# If the context has sessions, the connections are reused.
+# If the context has a breaker, a host which is down is not tried again.
+# If the context has a dns_cache, a host which does not exist is not tried.
+# Returns a dict with the "status" of the final response and the
+# "redirects", a list of the "status" and the URL redirected "to" of each hop,
+# and if the URL could not be checked, the "reason", or if the context has
+# a deadline which was reached before the check finished, "not-reached".
+def check_url(url, timeout, ctx=None):
+	ctx = ensure_context(ctx)
 	user_agent = 'url-check github.com/publiccodenet/url-check'
 	user_agent += f' v{url_check_version}'
 	headers = {
@@ -243,14 +1297,156 @@ def status_code_for_url(url, timeout, ctx=None):
 	# and/or 'git config --get user.email' for this.
 	# 'From': 'info@examle.org',
 
+	redirects = []
+	tries = 0
 	try:
-		response = requests.head(
-				url, allow_redirects=True, timeout=timeout, headers=headers)
-		return response.status_code
+		while True:
+			hop = None
+			if ctx.redirect_cache is not None:
+				hop = ctx.redirect_cache.get(url)
+			if hop is None:
+				host = host_of_url(url)
+				if is_no_such_host(host, ctx):
+					return {"status": 0, "redirects": redirects, "reason": "NXDOMAIN"}
+				if ctx.breaker is not None and ctx.breaker.is_open(host):
+					reason = f"circuit open: {host} is not responding"
+					return {
+							"status": circuit_open_status,
+							"redirects": redirects,
+							"reason": reason
+					}
+				http = requests
+				if ctx.sessions is not None:
+					http = ctx.sessions.session_for(url)
+				try:
+					response = request_url(http, url, timeout, headers, ctx)
+				except (requests.ConnectionError, requests.Timeout):
+					# cut short by the deadline, rather than the host being down
+					if deadline_passed(ctx):
+						raise Deadline_Passed()
+					if ctx.breaker is not None:
+						ctx.breaker.record(host, False)
+					raise
+				if ctx.breaker is not None:
+					ctx.breaker.record(host, True)
+				if response.status_code in retry_after_codes:
+					delay = retry_after_seconds(response)
+					if delay is not None and tries < retry_after_tries:
+						tries += 1
+						ctx.debug({'url': url, 'Retry-After': delay})
+						delay = min(delay, ctx.max_retry_after)
+						if deadline_passed(ctx, delay):
+							raise Deadline_Passed()
+						ctx.sleep(delay)
+						continue
+				if not response.is_redirect:
+					return {"status": response.status_code, "redirects": redirects}
+				location = urllib.parse.urljoin(url, response.headers["location"])
+				hop = (response.status_code, requests.utils.requote_uri(location))
+				if ctx.redirect_cache is not None:
+					ctx.redirect_cache[url] = hop
+			if len(redirects) >= max_redirects:
+				raise requests.TooManyRedirects(f"{max_redirects} redirects")
+			redirects.append({"status": hop[0], "to": hop[1]})
+			url = hop[1]
+	except Deadline_Passed:
+		return {"not-reached": True, "redirects": redirects}
 	except Exception as e:
-		ctx = ensure_context(ctx)
 		ctx.debug({'url': url, 'error': e})
-		return 0
+		return {"status": 0, "redirects": redirects, "reason": type(e).__name__}
+
+
+def status_code_for_url(url, timeout, ctx=None):
+	return check_url(url, timeout, ctx)["status"]
+
+
+# Before python 3.12, cProfile only profiles the thread in which it is
+# enabled, thus the work run in the thread pools is profiled by wrapping
+# each call, see profiled(), and there is a profile for each phase in each
+# thread. From python 3.12, cProfile uses sys.monitoring, which allows only
+# a single profile to be enabled at a time, which then sees the calls of
+# every thread, thus there is a single profile for each phase.
+# The main thread switches profile as it enters and leaves each phase
+# (via ctx.phase), and a call in a worker thread is added to the profile
+# of the phase which the main thread is in.
+# Outside of the phases, the phase is "main".
+profile_sees_all_threads = sys.version_info >= (3, 12)
+
+
+class Profiler:
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.profiles = {}
+		self.threads = {}
+		self.lock = threading.Lock()
+		self.phase = None
+		self.main = None
+		self.enter("main")
+
+	# also notes the thread as one of those of the phase
+	def profile_for(self, phase):
+		thread = threading.get_ident()
+		key = (phase, None if profile_sees_all_threads else thread)
+		with self.lock:
+			self.threads.setdefault(phase, set()).add(thread)
+			if key not in self.profiles:
+				self.profiles[key] = cProfile.Profile()
+			return self.profiles[key]
+
+	# called from the main thread
+	def enter(self, phase):
+		if self.main:
+			self.main.disable()
+		self.phase = phase
+		self.main = self.profile_for(phase)
+		self.main.enable()
+
+	def call(self, fn, *args, **kwargs):
+		profile = self.profile_for(self.phase)
+		if profile_sees_all_threads:
+			return fn(*args, **kwargs)
+		profile.enable()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			profile.disable()
+
+	# writes a "<phase>.pstats" for each phase, and an "all.pstats",
+	# each merged from all of the threads, and a "summary.txt" with
+	# the time of each phase and its most costly functions
+	def save(self, timings=None):
+		self.main.disable()
+		timings = timings or {}
+		os.makedirs(self.directory, exist_ok=True)
+		phases = list(self.threads.keys())
+
+		summary = io.StringIO()
+		for phase in phases:
+			profiles = [
+					profile for (name, _), profile in self.profiles.items()
+					if name == phase
+			]
+			stats = pstats.Stats(*profiles, stream=summary)
+			stats.dump_stats(os.path.join(self.directory, f"{phase}.pstats"))
+			wall = timings.get(phase)
+			wall = f"{wall:.3f} seconds" if wall is not None else "-"
+			threads = len(self.threads[phase])
+			summary.write(f"phase {phase}: {wall}, {threads} threads\n")
+			stats.sort_stats("cumulative").print_stats(20)
+
+		everything = pstats.Stats(*self.profiles.values(), stream=summary)
+		everything.dump_stats(os.path.join(self.directory, "all.pstats"))
+		with open(os.path.join(self.directory, "summary.txt"), "w") as outfile:
+			outfile.write(summary.getvalue())
+
+
+# the function, or if the run is being profiled,
+# a function which calls it under the profile of this thread
+def profiled(fn, ctx):
+	if ctx.profiler is None:
+		return fn
+	return functools.partial(ctx.profiler.call, fn)
 
 
 # The System_Context class exists so that tests can intercept system functions.
@@ -264,10 +1460,63 @@ class System_Context:
 
 	verbose = False
 	dry_run = False
+	extract = "files"
+	results_format = "json"
+	extract_cache = None
+	sync_jobs = 8
+	concurrency = 100
+	per_host = 4
+	per_host_rate = 0
+	public_suffix_list = default_public_suffix_list
+	freshness = {}
+	sessions = None
+	redirect_cache = None
+	strategies = {}
+	breaker = None
+	max_retry_after = 30
+	dns_cache = None
+	timings = None
+	latencies = None
+	profiler = None
+	shard = None
+	deadline = None
+	checkpoint = None
+	checkpoint_interval = 60
+	incremental = False
+	repo_commits = None
+	previous_commits = {}
 
 	def now(self):
 		return str(datetime.datetime.utcnow())
 
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+	def monotonic(self):
+		return time.monotonic()
+
+	# adds the seconds spent in the block to the timings of the phase
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = self.monotonic()
+		previous = None
+		if self.profiler:
+			previous = self.profiler.phase
+			self.profiler.enter(name)
+		try:
+			yield
+		finally:
+			if self.profiler:
+				self.profiler.enter(previous)
+			seconds = self.monotonic() - start
+			if self.timings is None:
+				self.timings = {}
+			self.timings[name] = self.timings.get(name, 0) + seconds
+			self.debug(name, "took", round(seconds, 3), "seconds")
+
+	def resolve(self, host):
+		return [info[4][0] for info in socket.getaddrinfo(host, None)]
+
 	def log(self, *args, **kwargs):
 		print(*args, **kwargs)
 
@@ -288,21 +1537,67 @@ def ensure_context(ctx):
 	return ctx
 
 
-def read_repos_files(gits_dir, repos, ctx):
-	repo_files = {}
+def repo_files_for(gits_dir, repo_name, repo_data, ctx):
+	repo_url = repo_data.get("url")
+	branch = repo_data.get("branch")
+	ignore_map = repo_data.get("ignore_files", {})
+	ignore = ignore_map.keys()
 
-	for repo_name, repo_data in repos.items():
-		repo_url = repo_data.get("url")
-		branch = repo_data.get("branch")
-		ctx.log(repo_name, repo_url, branch)
-		files = files_from_repo(gits_dir, repo_name, repo_url, branch, ctx)
+	branches = repo_data.get("branches")
+	if branches:
+		ctx.log(repo_name, repo_url, branches)
+		return branches_files_for(gits_dir, repo_name, repo_url, branches, ignore,
+				ctx)
+
+	ctx.log(repo_name, repo_url, branch)
+	if ctx.extract == "blobs":
+		blobs = blobs_from_repo(gits_dir, repo_name, repo_url, branch, ctx)
+		if ctx.repo_commits is not None:
+			repo_dir = bare_repo_dir(gits_dir, repo_name)
+			ctx.repo_commits[repo_name] = repo_commit(repo_dir, branch, ctx)
+		return {file: blob for file, blob in blobs.items() if file not in ignore}
+
+	files = files_from_repo(gits_dir, repo_name, repo_url, branch, ctx)
+	if ctx.repo_commits is not None:
+		repo_dir = os.path.join(gits_dir, repo_name)
+		ctx.repo_commits[repo_name] = repo_commit(repo_dir, branch, ctx)
+	# filter elements in files that are not in ignore
+	return [file for file in files if file not in ignore]
+
+
+# The files of all of the branches are read from the object store, whatever
+# the extract mode, as a single dict of "<branch>:<file>" to the blob ID.
+def branches_files_for(gits_dir, repo_name, repo_url, branches, ignore, ctx):
+	branches_blobs = branches_blobs_from_repo(gits_dir, repo_name, repo_url,
+			branches, ctx)
+	if ctx.repo_commits is not None:
+		repo_dir = bare_repo_dir(gits_dir, repo_name)
+		ctx.repo_commits[repo_name] = {
+				branch: repo_commit(repo_dir, branch, ctx) for branch in branches
+		}
+	files = {}
+	for branch, blobs in branches_blobs.items():
+		for file, blob in blobs.items():
+			if file not in ignore:
+				files[branch_file(branch, file)] = blob
+	return files
 
-		ignore_map = repo_data.get("ignore_files", {})
-		ignore = ignore_map.keys()
-		# filter elements in files that are not in ignore
-		filtered = [file for file in files if file not in ignore]
 
-		repo_files[repo_name] = filtered
+# the repositories are cloned or fetched ctx.sync_jobs at a time,
+# as this is mostly waiting on the network
+def read_repos_files(gits_dir, repos, ctx):
+	max_workers = max(1, ctx.sync_jobs)
+	with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+		futures = {
+				repo_name:
+				executor.submit(
+				profiled(repo_files_for, ctx), gits_dir, repo_name, repo_data, ctx)
+				for repo_name, repo_data in repos.items()
+		}
+
+	repo_files = {}
+	for repo_name, future in futures.items():
+		repo_files[repo_name] = future.result()
 
 	return repo_files
 
@@ -331,41 +1626,418 @@ def update_status(check, status_code, when, ctx):
 	return check
 
 
-def update_status_codes_for_urls(urls, checks, timeout, ctx):
-	updated = []
-	ctx.debug("update_status_codes_for_urls:", urls)
-	for url in urls:
-		ctx.log("")
-		when = ctx.now()
-		ctx.log(when, url)
-		status_code = -1
-		if not ctx.dry_run:
-			status_code = status_code_for_url(url, timeout, ctx)
-		ctx.log(status_code, url)
-		update_status(checks[url]["checks"], status_code, when, ctx)
-		updated.append(checks[url])
-	ctx.debug("updated:", updated)
-	return updated
+# The hours after a successful check during which a URL is not checked
+# again, from the "freshness" of the config, e.g.:
+#	"freshness": {
+#		"ttl_hours": 24,
+#		"jitter": 0.25,
+#		"patterns": { "^https://github\\.com/": 72 }
+#	}
+# the first of the "patterns" which matches the URL overrides "ttl_hours".
+# The "jitter" shortens the TTL by up to that fraction, by an amount fixed
+# for each URL, so that URLs first verified together expire at different
+# times, spreading the checks over the runs.
+def freshness_ttl_hours(url, freshness):
+	ttl = freshness.get("ttl_hours", 0)
+	for pattern, hours in freshness.get("patterns", {}).items():
+		if grep_patterns_regex((pattern,)).search(url):
+			ttl = hours
+			break
+	digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+	fraction = int(digest[:8], 16) / 0x100000000
+	return ttl * (1 - (freshness.get("jitter", 0) * fraction))
+
+
+# only URLs which are passing are fresh, new or failing URLs are not
+def is_fresh(check, url, now, freshness):
+	if check.get("status") != 200 or "200" not in check:
+		return False
+	ttl = freshness_ttl_hours(url, freshness)
+	if ttl <= 0:
+		return False
+	verified = datetime.datetime.fromisoformat(check["200"])
+	return (now - verified) < datetime.timedelta(hours=ttl)
+
+
+# the URLs which are fresh are not checked, their outcome is "skipped"
+def stale_urls(checks, ctx):
+	if not ctx.freshness:
+		return list(checks.keys())
+	now = datetime.datetime.fromisoformat(ctx.now())
+	stale = []
+	for url, check in checks.items():
+		if is_fresh(check["checks"], url, now, ctx.freshness):
+			check["checks"]["outcome"] = "skipped"
+		else:
+			stale.append(url)
+	return stale
+
 
+default_ports = {
+		"http": 80,
+		"https": 443,
+}
 
-def group_by_second_level_domain(urls, ctx):
+
+# Variants of a URL which are the same resource give the same canonical URL:
+# the scheme and host are lower case, the default port and the fragment are
+# dropped, as is trailing punctuation (most often the end of a sentence),
+# and an empty path is "/"
+def canonical_url(url):
+	url = url.rstrip(".,;:!?")
+	try:
+		parts = urllib.parse.urlsplit(url)
+		port = parts.port
+	except ValueError:
+		return url
+	if not parts.hostname:
+		return url
+	scheme = parts.scheme.lower()
+	netloc = parts.hostname
+	if ":" in netloc:
+		netloc = f"[{netloc}]"
+	if port and port != default_ports.get(scheme):
+		netloc += f":{port}"
+	userinfo = parts.netloc.rpartition("@")[0]
+	if userinfo:
+		netloc = userinfo + "@" + netloc
+	path = parts.path or "/"
+	return urllib.parse.urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def group_by_canonical_url(urls):
+	canonical_dict = {}
+	for url in urls:
+		canonical_dict.setdefault(canonical_url(url), []).append(url)
+	return canonical_dict
+
+
+def check_outcome(status_code):
+	if status_code == 200:
+		return "passed"
+	if status_code > 0:
+		return "failed"
+	if status_code == circuit_open_status:
+		return "skipped"
+	if status_code == -1:
+		return "not-checked"
+	return "error"
+
+
+# the checks are updated from the worker threads,
+# while the checkpoints take copies of them
+checks_lock = threading.Lock()
+
+
+# the url is checked once, and the status applied to each of the originals,
+# (by default, just the url itself), returns the updated checks
+def update_status_code_for_url(url, checks, timeout, ctx, originals=None):
+	if originals is None:
+		originals = [url]
+	ctx.log("")
+	when = ctx.now()
+	ctx.log(when, url)
+	result = {"status": -1, "redirects": []}
+	start = ctx.monotonic()
+	if not ctx.dry_run:
+		result = check_url(url, timeout, ctx)
+	if result.get("not-reached"):
+		ctx.log("not reached before the deadline", url)
+		mark_not_reached(checks, originals, when)
+		return [checks[original] for original in originals]
+	latency = round(ctx.monotonic() - start, 3)
+	status_code = result["status"]
+	if result.get("reason"):
+		ctx.log(status_code, url, result["reason"])
+	else:
+		ctx.log(status_code, url)
+	with checks_lock:
+		for original in originals:
+			check = checks[original]["checks"]
+			update_status(check, status_code, when, ctx)
+			check.pop("not-reached", None)
+			check.pop("redirects", None)
+			if result["redirects"]:
+				check["redirects"] = result["redirects"]
+			check.pop("reason", None)
+			if result.get("reason"):
+				check["reason"] = result["reason"]
+			check["latency"] = latency
+			check["outcome"] = check_outcome(status_code)
+		# once for the url checked, whatever the number of originals
+		if ctx.latencies is not None and check_outcome(status_code) in [
+				"passed", "failed", "error"
+		]:
+			ctx.latencies[url] = latency
+	return [checks[original] for original in originals]
+
+
+# Used if the Public Suffix List is not installed, these are the suffixes
+# under which unrelated sites are most commonly found in our repositories.
+fallback_public_suffixes = [
+		"ac.uk",
+		"co.jp",
+		"co.nz",
+		"co.uk",
+		"com.au",
+		"com.br",
+		"github.io",
+		"gitlab.io",
+		"gov.uk",
+		"herokuapp.com",
+		"netlify.app",
+		"org.uk",
+		"pages.dev",
+		"readthedocs.io",
+		"vercel.app",
+]
+
+
+# The rules of the Public Suffix List https://publicsuffix.org/list/
+# one per line, ignoring comments and anything after whitespace
+@functools.lru_cache(maxsize=None)
+def public_suffix_rules(psl_path):
+	if not (psl_path and os.path.exists(psl_path)):
+		return frozenset(fallback_public_suffixes)
+	rules = set()
+	with open(psl_path, "r", encoding="utf-8") as in_file:
+		for line in in_file:
+			line = line.strip()
+			if line and not line.startswith("//"):
+				rules.add(line.split()[0].lower())
+	return frozenset(rules)
+
+
+# The registrable domain is the public suffix plus one label,
+# e.g.: "www.example.co.uk" is "example.co.uk", and
+# "foo.github.io" is itself, as "github.io" is a public suffix
+def registrable_domain(host, psl_path=None):
+	rules = public_suffix_rules(psl_path)
+	labels = host.lower().strip(".").split(".")
+	if re.fullmatch(r"[0-9.]+|\[.*\]", host) or len(labels) < 2:
+		return host
+	# the default rule is "*", the last label is the public suffix
+	suffix_start = len(labels) - 1
+	for i in range(len(labels)):
+		candidate = ".".join(labels[i:])
+		if "!" + candidate in rules:
+			suffix_start = i + 1
+			break
+		parent = ".".join(labels[i + 1:])
+		if candidate in rules or (parent and "*." + parent in rules):
+			suffix_start = i
+			break
+	if suffix_start == 0:
+		return host
+	return ".".join(labels[suffix_start - 1:])
+
+
+def group_by_registrable_domain(urls, ctx):
 	domain_dict = {}
 
 	for url in sorted(set(urls)):
-		parsed_url = urllib.parse.urlparse(url)
-		domain = parsed_url.netloc
-		# split by dot; get the last two parts
-		domain_parts = domain.split('.')[-2:]
-		second_level_domain = '.'.join(domain_parts)
+		host = host_of_url(url)
+		domain = registrable_domain(host, ctx.public_suffix_list)
 
-		if second_level_domain not in domain_dict:
-			domain_dict[second_level_domain] = []
+		if domain not in domain_dict:
+			domain_dict[domain] = []
 
-		domain_dict[second_level_domain].append(url)
+		domain_dict[domain].append(url)
 
 	return domain_dict
 
 
+# The order in which a run checks the URLs, so that if the run is cut short,
+# the checks which matter most are done: the new URLs first, then the
+# failing, then the passing, each the least recently checked first
+def check_priority(check):
+	when = last_checked(check)
+	if when is None:
+		return (0, "")
+	if check.get("status") != 200:
+		return (1, when)
+	return (2, when)
+
+
+# the share of the --deadline left for writing the results and reports
+deadline_report_share = 0.1
+
+
+# URLs which were not checked before the deadline keep their previous status
+def mark_not_reached(checks, urls, when):
+	with checks_lock:
+		for url in urls:
+			checks[url]["checks"]["not-reached"] = when
+
+
+# Checking is almost entirely waiting on the network, thus rather than a
+# few processes each checking one URL at a time, the checks are scheduled
+# with asyncio, limited to ctx.concurrency in flight overall and, per site
+# (registrable domain), to ctx.per_host in flight and to ctx.per_host_rate
+# started per second. The blocking requests calls run in a thread pool
+# the size of the overall limit, which takes the next check which is not
+# held back by its site's limits, thus a site with many URLs does not
+# keep the other sites waiting.
+# If the context has a deadline, no check is started after the deadline
+# less the timeout, and the checks in flight are stopped at the deadline,
+# see check_url.
+# If the context has a checkpoint, it is called with a copy of the checks
+# every ctx.checkpoint_interval seconds.
+async def update_status_codes_async(urls, checks, timeout, ctx):
+	loop = asyncio.get_running_loop()
+	canonical_dict = group_by_canonical_url(urls)
+	domain_dict = group_by_registrable_domain(canonical_dict.keys(), ctx)
+	limits = {domain: asyncio.Semaphore(ctx.per_host) for domain in domain_dict}
+	next_start = {domain: 0.0 for domain in domain_dict}
+
+	def priority(url):
+		return min(
+				check_priority(checks[original]["checks"])
+				for original in canonical_dict[url])
+
+	def too_late():
+		return ctx.deadline is not None and ctx.monotonic() > ctx.deadline - timeout
+
+	async def check_url(url, domain, executor):
+		async with limits[domain]:
+			if too_late():
+				mark_not_reached(checks, canonical_dict[url], ctx.now())
+				return []
+			if ctx.per_host_rate > 0:
+				now = loop.time()
+				start = max(now, next_start[domain])
+				next_start[domain] = start + (1.0 / ctx.per_host_rate)
+				await asyncio.sleep(start - now)
+			update = profiled(update_status_code_for_url, ctx)
+			return await loop.run_in_executor(executor, update, url, checks, timeout,
+					ctx, canonical_dict[url])
+
+	async def checkpoints(writer):
+		while True:
+			await asyncio.sleep(ctx.checkpoint_interval)
+			with checks_lock:
+				snapshot = copy.deepcopy(checks)
+			await loop.run_in_executor(writer, ctx.checkpoint, snapshot)
+
+	# Start the sites with the most URLs first, so that they are not the
+	# last still running, and interleave the sites so that the first URLs
+	# of every site are queued before the later URLs of any one site,
+	# then start all of the new URLs before the failing, and the failing
+	# before the passing.
+	groups = sorted(domain_dict.items(), key=lambda item: -len(item[1]))
+	groups = [(domain, sorted(group, key=priority)) for domain, group in groups]
+	longest = len(groups[0][1]) if groups else 0
+	ordered = []
+	for i in range(longest):
+		for domain, domain_urls in groups:
+			if i < len(domain_urls):
+				ordered.append((domain_urls[i], domain))
+	ordered.sort(key=lambda item: priority(item[0])[0])
+
+	max_workers = max(1, ctx.concurrency)
+	# leaving the writer waits for a checkpoint being written
+	with concurrent.futures.ThreadPoolExecutor(1) as writer:
+		checkpointing = None
+		if ctx.checkpoint and ctx.checkpoint_interval > 0:
+			checkpointing = asyncio.create_task(checkpoints(writer))
+		with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+			updated = await asyncio.gather(
+					*[check_url(url, domain, executor) for url, domain in ordered])
+		if checkpointing:
+			checkpointing.cancel()
+			with contextlib.suppress(asyncio.CancelledError):
+				await checkpointing
+	return [check for group in updated for check in group]
+
+
+# "2/4" as (2, 4)
+def parse_shard(shard):
+	index, count = [int(part) for part in shard.split("/")]
+	if not 1 <= index <= count:
+		raise ValueError(
+				f"shard {shard} is not one of 1/{count} to {count}/{count}")
+	return (index, count)
+
+
+# the shard, from 1 to count, of the site of the URL,
+# the same for every run, so that the shards of a run do not overlap
+def shard_of_url(url, count, ctx):
+	domain = registrable_domain(host_of_url(url), ctx.public_suffix_list)
+	digest = hashlib.sha1(domain.encode("utf-8")).hexdigest()
+	return (int(digest[:8], 16) % count) + 1
+
+
+def shard_urls(urls, ctx):
+	index, count = ctx.shard
+	return [url for url in urls if shard_of_url(url, count, ctx) == index]
+
+
+# Each shard has all of the URLs of the repositories, but has only checked
+# those of its sites, which extends the check history of those URLs,
+# thus for each URL, the entry which was checked most recently is kept.
+def merge_results(shards_checks):
+	merged = {}
+	for checks in shards_checks:
+		for url, entry in checks.items():
+			when = last_checked(entry["checks"]) or ""
+			if url not in merged or when > merged[url][0]:
+				merged[url] = (when, entry)
+	return sort_by_key({url: entry for url, (when, entry) in merged.items()})
+
+
+# finds the URLs used in the files of the repositories, removes the
+# entries of URLs no longer used, and notes the canonical URL of each
+def extract_checks(
+		gits_dir, checks, repos_files, ignore_patterns, transforms, ctx):
+	for url in checks.keys():
+		if ctx.incremental:
+			# keep the usages of the repositories which are still checked
+			used = checks[url]["used"]
+			checks[url]["used"] = {
+					name: files for name, files in used.items() if name in repos_files
+			}
+		else:
+			checks[url]["used"] = {}
+
+	with ctx.phase("extract"):
+		for repo_name, files in repos_files.items():
+			ctx.log(repo_name, "contains", len(files), "files")
+			ctx.debug(files)
+			changed = None
+			if ctx.incremental:
+				changed = changed_files_for(gits_dir, repo_name, ctx)
+			if changed is None:
+				set_used(checks, gits_dir, repo_name, files, ignore_patterns,
+						transforms, ctx)
+			else:
+				update_used(checks, gits_dir, repo_name, files, changed,
+						ignore_patterns, transforms, ctx)
+
+		ctx.debug("checks length:", len(checks), "before unused removed")
+		checks = remove_unused(checks)
+	ctx.log("performing", len(checks), "checks")
+
+	checks = sort_by_key(checks)
+
+	# note the canonical URL which was checked for the variants
+	for url, check in checks.items():
+		check.pop("canonical", None)
+		canonical = canonical_url(url)
+		if canonical != url:
+			check["canonical"] = canonical
+
+	return checks
+
+
+def check_urls(urls, checks, timeout, ctx):
+	if ctx.dns_cache is not None and not ctx.dry_run:
+		with ctx.phase("resolve"):
+			resolve_hosts(urls, ctx)
+
+	with ctx.phase("check"):
+		asyncio.run(update_status_codes_async(urls, checks, timeout, ctx))
+
+
 def url_check_all(gits_dir,
 		checks,
 		repos_files,
@@ -374,36 +2046,98 @@ def url_check_all(gits_dir,
 		transforms=[],
 		ctx=None):
 
-	for url in checks.keys():
-		checks[url]["used"] = {}
+	checks = extract_checks(gits_dir, checks, repos_files, ignore_patterns,
+			transforms, ctx)
 
-	for repo_name, files in repos_files.items():
-		ctx.log(repo_name, "contains", len(files), "files")
-		ctx.debug(files)
-		set_used(checks, gits_dir, repo_name, files, ignore_patterns, transforms,
-				ctx)
+	urls = stale_urls(checks, ctx)
+	if len(urls) < len(checks):
+		ctx.log("skipping", len(checks) - len(urls), "recently verified URLs")
 
-	ctx.debug("checks length:", len(checks), "before unused removed")
-	checks = remove_unused(checks)
-	ctx.log("performing", len(checks), "checks")
+	if ctx.incremental:
+		urls = [url for url in urls if "status" not in checks[url]["checks"]]
+		ctx.log("checking", len(urls), "new URLs")
 
-	checks = sort_by_key(checks)
+	if ctx.shard:
+		stale = len(urls)
+		urls = shard_urls(urls, ctx)
+		ctx.log("checking", len(urls), "of", stale, "URLs in shard",
+				"/".join(str(part) for part in ctx.shard))
+
+	check_urls(urls, checks, timeout, ctx)
+
+	not_reached = [url for url in urls if "not-reached" in checks[url]["checks"]]
+	if not_reached:
+		ctx.log(len(not_reached), "URLs not reached before the deadline")
+
+	return sort_by_key(checks)
 
-	domain_dict = group_by_second_level_domain(checks.keys(), ctx)
-	pool = multiprocessing.Pool(processes=16)
-	pfunc = functools.partial(
-			update_status_codes_for_urls, checks=checks, timeout=timeout, ctx=ctx)
-	updated = pool.map(pfunc, domain_dict.values())
-	pool.close()
-	pool.join()
 
-	updated_checks = {}
-	for group in updated:
-		for check in group:
-			url = check["url"]
-			updated_checks[url] = check
+# The order in which the daemon checks the stale URLs: the least recently
+# checked first, and of those checked at the same time, the new URLs,
+# then the failing, then the passing.
+def recheck_priority(check):
+	rank, when = check_priority(check)
+	return (when, rank)
 
-	return sort_by_key(updated_checks)
+
+def recheck_queue(checks, batch, ctx):
+	urls = stale_urls(checks, ctx)
+	return heapq.nsmallest(
+			batch, urls, key=lambda url: recheck_priority(checks[url]["checks"]))
+
+
+# Rather than a run which syncs, extracts and checks everything and exits,
+# the daemon keeps the repositories, the extract cache and the sessions
+# between batches of checks, and only syncs and extracts again each resync.
+# The caches of the redirects, hosts and hosts which are down are started
+# again with each sync, as those may change. The reports are written after
+# each batch. It runs until interrupted, or for the number of cycles given.
+def run_daemon(gits_dir,
+		repos_info,
+		checks_path,
+		timeout,
+		ignore_patterns,
+		transforms,
+		ctx,
+		interval=60,
+		batch=500,
+		resync_seconds=3600,
+		cycles=None):
+	checks, store = read_checks(checks_path)
+	synced = None
+	cycle = 0
+	while cycles is None or cycle < cycles:
+		if synced is None or ctx.monotonic() - synced >= resync_seconds:
+			synced = ctx.monotonic()
+			with ctx.phase("sync"):
+				repos_files = read_repos_files(gits_dir, repos_info, ctx)
+			checks = extract_checks(gits_dir, checks, repos_files, ignore_patterns,
+					transforms, ctx)
+			if ctx.extract_cache is not None:
+				ctx.extract_cache.save()
+				ctx.extract_cache.next_run()
+			if ctx.redirect_cache is not None:
+				ctx.redirect_cache = {}
+			if ctx.dns_cache is not None:
+				ctx.dns_cache = {}
+			if ctx.breaker is not None:
+				ctx.breaker = Circuit_Breaker(ctx.breaker.threshold)
+
+		urls = recheck_queue(checks, batch, ctx)
+		ctx.log("checking", len(urls), "URLs")
+		if urls:
+			check_urls(urls, checks, timeout, ctx)
+			# as for a single run, a dry run does not write the results
+			if ctx.dry_run:
+				ctx.log({url: checks[url] for url in urls})
+			else:
+				with ctx.phase("report"):
+					write_reports(checks, repos_info, checks_path, store, ctx)
+
+		cycle += 1
+		if cycles is None or cycle < cycles:
+			ctx.sleep(interval)
+	return checks
 
 
 def condense_results(checks, repos):
@@ -415,26 +2149,35 @@ def condense_results(checks, repos):
 	for repo in repos:
 		results["repos"][repo] = "passing"
 
+	# URLs not yet checked, e.g.: by the daemon, are not failing,
+	# URLs not reached before the deadline are listed, but are only
+	# failing if their previous status was failing
 	for url, check in checks.items():
-		if check["checks"]["status"] != 200:
+		failing = check["checks"].get("status", 200) != 200
+		if failing or "not-reached" in check["checks"]:
 			results["urls"][url] = check
+		if failing:
 			for repo in check["used"].keys():
 				results["repos"][repo] = "failing"
 
 	return results
 
 
-def write_repo_files(
-		repo, repo_checks, repo_condensed, checks_path, check_fails_json):
+def write_repo_files(repo,
+		repo_checks,
+		repo_condensed,
+		checks_path,
+		check_fails_json,
+		results_format="json"):
 	report_dir = os.path.dirname(check_fails_json)
 	repo_check_base = repo + '-' + os.path.basename(checks_path)
 	repo_checks_path = os.path.join(report_dir, repo_check_base)
-	write_json(repo_checks_path, repo_checks)
+	write_results(repo_checks_path, repo_checks, results_format)
 
 	fails_base = os.path.basename(check_fails_json)
 	repo_fails_base = repo + '-' + fails_base
 	repo_condensed_path = os.path.join(report_dir, repo_fails_base)
-	write_json(repo_condensed_path, repo_condensed)
+	write_results(repo_condensed_path, repo_condensed, results_format)
 
 	look_base = repo + '-url-check-look.json'
 	look = pathlib.Path(os.path.join(report_dir, look_base))
@@ -447,21 +2190,181 @@ def write_repo_files(
 	look.symlink_to(os.path.abspath(best))
 
 
-def repo_results(repos_info, checks, checks_path, check_fails_json):
-	for repo in repos_info.keys():
-		repo_checks = {}
-		for url, check in checks.items():
-			if repo in check["used"].keys():
-				repo_checks[url] = check
+# a single pass over the checks indexes the URLs used by each repository,
+# rather than scanning every URL once per repository
+def urls_by_repo(checks, repos):
+	index = {repo: {} for repo in repos}
+	for url, check in checks.items():
+		for repo in check["used"].keys():
+			if repo in index:
+				index[repo][url] = check
+	return index
+
+
+def repo_results(repos_info, checks, checks_path, check_fails_json, ctx=None):
+	ctx = ensure_context(ctx)
+	index = urls_by_repo(checks, repos_info.keys())
+
+	def write_repo(repo):
+		repo_checks = index[repo]
 		repo_condensed = condense_results(repo_checks, [repo])
 		write_repo_files(repo, repo_checks, repo_condensed, checks_path,
-				check_fails_json)
+				check_fails_json, ctx.results_format)
+
+	# each repository writes its own files, so they are written in parallel
+	max_workers = max(1, ctx.sync_jobs)
+	with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+		list(executor.map(profiled(write_repo, ctx), index.keys()))
+
+
+# the nearest-rank percentile of the values
+def percentile(values, fraction):
+	ordered = sorted(values)
+	rank = max(1, math.ceil(len(ordered) * fraction))
+	return ordered[rank - 1]
+
+
+def prometheus_label(value):
+	value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+	return value.replace('"', '\\"')
+
+
+# Writes the timings of the phases of the run, the number of URLs by the
+# status of their last check, and the latency percentiles of each host,
+# of the URLs requested in this run (ctx.latencies),
+# in the Prometheus textfile format, e.g.: for the node exporter's
+# textfile collector, which may read the file at any time, thus
+# the file is written to the side, then moved in to place.
+def write_metrics(metrics_path, checks, ctx):
+	lines = [
+			"# HELP url_check_phase_seconds Time spent in each phase of the run.",
+			"# TYPE url_check_phase_seconds gauge",
+	]
+	for phase, seconds in (ctx.timings or {}).items():
+		lines.append(f'url_check_phase_seconds{{phase="{phase}"}} {seconds:.3f}')
+
+	statuses = {}
+	for url, entry in checks.items():
+		status = entry["checks"].get("status")
+		statuses[status] = statuses.get(status, 0) + 1
+
+	latencies = {}
+	for url, latency in (ctx.latencies or {}).items():
+		latencies.setdefault(host_of_url(url), []).append(latency)
+
+	lines += [
+			"# HELP url_check_urls URLs by the status of their last check.",
+			"# TYPE url_check_urls gauge",
+	]
+	for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+		lines.append(f'url_check_urls{{status="{status}"}} {count}')
+
+	lines += [
+			"# HELP url_check_host_latency_seconds Latency of the checks of a host.",
+			"# TYPE url_check_host_latency_seconds gauge",
+	]
+	for host, values in sorted(latencies.items()):
+		host = prometheus_label(host)
+		for quantile in [0.5, 0.95]:
+			value = percentile(values, quantile)
+			labels = f'host="{host}",quantile="{quantile}"'
+			lines.append(f"url_check_host_latency_seconds{{{labels}}} {value:.3f}")
+
+	lines += [
+			"# HELP url_check_last_run_timestamp_seconds When the run finished.",
+			"# TYPE url_check_last_run_timestamp_seconds gauge",
+			f"url_check_last_run_timestamp_seconds {time.time():.0f}",
+	]
+
+	tmp_path = metrics_path + ".tmp"
+	with open(tmp_path, "w") as outfile:
+		outfile.write("\n".join(lines) + "\n")
+	os.replace(tmp_path, metrics_path)
+
+
+# An incremental run records the commit of each repository which it
+# extracted, next to the results, with the extract settings, as
+# a change of those settings means that all of the files are extracted.
+# The settings of each repository are recorded too, so that a repository
+# whose ignored files or extract mode changed is extracted in full,
+# e.g.: a file no longer ignored, but not changed since the last run.
+def commits_path(checks_path):
+	return os.path.splitext(checks_path)[0] + "-commits.json"
+
+
+def repos_extract_settings(repos_info, ctx):
+	return {
+			name: {
+			"extract": ctx.extract,
+			"ignore_files": sorted(repo_data.get("ignore_files", {}).keys()),
+			} for name, repo_data in repos_info.items()
+	}
+
+
+# the commits of the last run, of the repositories with the same settings
+def read_commits(checks_path, settings, repos_settings):
+	state = read_json(commits_path(checks_path))
+	if state.get("settings") != settings:
+		return {}
+	previous_settings = state.get("repos_settings", {})
+	return {
+			name: commit
+			for name, commit in state.get("repos", {}).items()
+			if name in repos_settings and
+			previous_settings.get(name) == repos_settings[name]
+	}
+
+
+def write_commits(checks_path, settings, repos_settings, repo_commits):
+	repos_settings = {name: repos_settings[name] for name in repo_commits}
+	state = {
+			"settings": settings,
+			"repos": sort_by_key(repo_commits),
+			"repos_settings": sort_by_key(repos_settings),
+	}
+	write_results(commits_path(checks_path), state)
+
+
+# returns the results, and if they are in an SQLite database, the store
+def read_checks(checks_path):
+	if is_sqlite_path(checks_path):
+		store = Sqlite_Store(checks_path)
+		return store.load(), store
+	return read_results(checks_path), None
+
+
+def write_checks(checks, checks_path, store, ctx):
+	if store:
+		store.save(checks)
+	else:
+		write_results(checks_path, checks, ctx.results_format)
+
+
+def write_reports(checks, repos_info, checks_path, store, ctx):
+	write_checks(checks, checks_path, store, ctx)
+	report_path = checks_path
+	if store:
+		# the per repository reports are still JSON
+		report_path = os.path.splitext(checks_path)[0] + ".json"
+	condensed = condense_results(checks, repos_info.keys())
+	write_results(check_fails_json, condensed, ctx.results_format)
+	repo_results(repos_info, checks, report_path, check_fails_json, ctx)
+
+
+def merge_shards(shard_paths, repos_info, checks_path, ctx):
+	shards_checks = [read_checks(path)[0] for path in shard_paths]
+	checks = merge_results(shards_checks)
+	ctx.log("merged", len(checks), "URLs from", len(shard_paths), "shards")
+	store = read_checks(checks_path)[1]
+	with ctx.phase("report"):
+		write_reports(checks, repos_info, checks_path, store, ctx)
 
 
 def main(sys_argv=sys.argv, ctx=None):
 	args = docopt.docopt(docopt_str, argv=sys_argv[1:])
 
 	ctx = ensure_context(ctx)
+	started = ctx.monotonic()
 	ctx.verbose = args['--verbose']
 	ctx.debug(args)
 	if args['--version']:
@@ -469,11 +2372,40 @@ def main(sys_argv=sys.argv, ctx=None):
 		return
 
 	ctx.dry_run = args['--dry-run']
+	if args['--shard']:
+		ctx.shard = parse_shard(args['--shard'])
+	if args['--deadline']:
+		seconds = float(args['--deadline'])
+		ctx.deadline = started + seconds * (1 - deadline_report_share)
+	ctx.checkpoint_interval = float(args['--checkpoint'])
+	if args['--profile']:
+		ctx.profiler = Profiler(args['--profile'])
+	ctx.extract = args['--extract']
+	ctx.results_format = args['--format']
+	ctx.sync_jobs = int(args['--sync-jobs'])
+	ctx.concurrency = int(args['--concurrency'])
+	ctx.per_host = int(args['--per-host'])
+	ctx.per_host_rate = float(args['--per-host-rate'])
+	ctx.public_suffix_list = args['--public-suffix-list']
+	ctx.sessions = Session_Pool(
+			pool_size=int(args['--pool-size']),
+			retries=int(args['--retries']),
+			keep_alive=not args['--no-keep-alive'])
+	ctx.redirect_cache = {}
+	ctx.dns_cache = {}
+	ctx.latencies = {}
+	ctx.breaker = Circuit_Breaker(int(args['--host-errors']))
+	ctx.max_retry_after = float(args['--max-retry-after'])
 	gits_dir = args['--gits-dir']
 	cfg_path = args['--config']
 	checks_path = args['--results']
 	timeout = int(args['--timeout'])
 
+	ctx.extract_cache = None
+	if args['--extract-cache'] != "none":
+		cache_path = os.path.join(gits_dir, args['--extract-cache'])
+		ctx.extract_cache = Extract_Cache(cache_path)
+
 	config_obj = read_json(cfg_path)
 	repos_info = config_obj["repositories"]
 	ignore_patterns_map = config_obj.get("ignore_patterns", {})
@@ -481,21 +2413,77 @@ def main(sys_argv=sys.argv, ctx=None):
 	# TODO: transforms_map should be ordered, perhaps convert to list?
 	transforms_map = config_obj.get("transforms", {})
 	transforms = transforms_map.keys()
+	ctx.freshness = config_obj.get("freshness", {})
+	ctx.strategies = config_obj.get("strategies", {})
 
-	repos_files = read_repos_files(gits_dir, repos_info, ctx)
-
-	orig_checks = read_json(checks_path)
-	checks = url_check_all(gits_dir, orig_checks, repos_files, timeout,
-			add_ignore_patterns, transforms, ctx)
-
-	if ctx.dry_run:
-		ctx.log(checks)
-		return
-
-	write_json(checks_path, checks)
-	condensed = condense_results(checks, repos_info.keys())
-	write_json(check_fails_json, condensed)
-	repo_results(repos_info, checks, checks_path, check_fails_json)
+	# the profile is written whichever the command, and however it ends
+	try:
+		if args['merge']:
+			merge_shards(args['SHARD_RESULTS'], repos_info, checks_path, ctx)
+			return
+
+		if args['daemon']:
+			try:
+				run_daemon(
+						gits_dir,
+						repos_info,
+						checks_path,
+						timeout,
+						add_ignore_patterns,
+						transforms,
+						ctx,
+						interval=float(args['--interval']),
+						batch=int(args['--batch']),
+						resync_seconds=float(args['--resync']) * 60)
+			except KeyboardInterrupt:
+				ctx.log("stopped")
+			finally:
+				ctx.sessions.close()
+			return
+
+		settings = None
+		repos_settings = None
+		if args['--incremental']:
+			ctx.incremental = True
+			ctx.repo_commits = {}
+			settings = extract_settings_hash(
+					tuple(add_ignore_patterns), tuple(transforms))
+			repos_settings = repos_extract_settings(repos_info, ctx)
+			ctx.previous_commits = read_commits(checks_path, settings, repos_settings)
+
+		with ctx.phase("sync"):
+			repos_files = read_repos_files(gits_dir, repos_info, ctx)
+
+		orig_checks, store = read_checks(checks_path)
+		if not ctx.dry_run:
+			ctx.checkpoint = functools.partial(
+					write_checks, checks_path=checks_path, store=store, ctx=ctx)
+		checks = url_check_all(gits_dir, orig_checks, repos_files, timeout,
+				add_ignore_patterns, transforms, ctx)
+		ctx.sessions.close()
+		if ctx.extract_cache is not None:
+			ctx.log("extract cache", ctx.extract_cache.hits, "hits,",
+					ctx.extract_cache.misses, "misses")
+			ctx.extract_cache.save()
+
+		if ctx.dry_run:
+			ctx.log(checks)
+		else:
+			with ctx.phase("report"):
+				# the reports of a sharded run are written by "merge"
+				if ctx.shard:
+					write_checks(checks, checks_path, store, ctx)
+				else:
+					write_reports(checks, repos_info, checks_path, store, ctx)
+				if ctx.incremental:
+					write_commits(checks_path, settings, repos_settings, ctx.repo_commits)
+
+			if args['--metrics']:
+				write_metrics(args['--metrics'], checks, ctx)
+	finally:
+		if ctx.profiler:
+			ctx.profiler.save(ctx.timings)
+			ctx.log("profiles written to", ctx.profiler.directory)
 
 
 if __name__ == "__main__":  # pragma: no cover
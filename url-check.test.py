@@ -2,10 +2,21 @@
 # SPDX-License-Identifier: CC0-1.0
 # SPDX-FileCopyrightText: 2023 The Foundation for Public Code <info@publiccode.net>
 
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import email.utils
+import http.server
 import json
 import os
+import pstats
 import re
+import socket
+import sqlite3
 import subprocess
+import threading
+import time
 import unittest
 
 uc = __import__("url-check")
@@ -19,6 +30,181 @@ def sort_dict_of_lists(unsorted):
 	return copy
 
 
+# create (or re-create) a git repository with a single commit of the files
+def make_test_repo(repo_dir, files, branch="main"):
+	subprocess.run(["rm", "-rf", repo_dir])
+	for file, contents in files.items():
+		path = os.path.join(repo_dir, file)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as out_file:
+			out_file.write(contents)
+	git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+	cmds = [
+			git + ["init", "--quiet", f"--initial-branch={branch}"],
+			git + ["add", "--all"],
+			git + ["commit", "--quiet", "--message=test"],
+	]
+	for cmd in cmds:
+		subprocess.run(cmd, cwd=repo_dir, check=True)
+	return repo_dir
+
+
+# runs the block in the directory, e.g.: as main writes the reports
+# to the current directory
+@contextlib.contextmanager
+def working_directory(path):
+	os.makedirs(path, exist_ok=True)
+	previous = os.getcwd()
+	os.chdir(path)
+	try:
+		yield path
+	finally:
+		os.chdir(previous)
+
+
+# (re-)creates a test directory with a repository for each of the dict of
+# names to files, and a config of them, returns the arguments of main
+def make_test_config(test_dir, repos_files, config={}):
+	subprocess.run(["rm", "-rf", test_dir])
+	repos = {}
+	for name, files in repos_files.items():
+		origin = make_test_repo(os.path.join(test_dir, "origins", name), files)
+		repos[name] = {"url": origin, "branch": "main"}
+	config_path = os.path.join(test_dir, "config.json")
+	uc.write_json(config_path, dict(config, repositories=repos))
+	return [
+			"url-check",
+			f"--gits-dir={os.path.join(test_dir, 'gits')}",
+			f"--config={config_path}",
+			f"--results={os.path.join(test_dir, 'results.json')}",
+			"--timeout=1",
+	]
+
+
+# Answers on the local host, so that checks can be tested without a network:
+#	/status/<code>	responds with the status code
+#	/redirect/<n>	redirects to /redirect/<n-1>, and /redirect/0 to /status/200
+#	/loop	redirects to itself
+#	/no-head	405 for HEAD, a GET honours "Range: bytes=0-0" with a 206
+#	/no-range	403 for HEAD, a GET ignores "Range" and sends the whole page
+#	/busy/<n>	503 with "Retry-After: 1" for the first <n> requests, then 200
+#	/busy-date/<form>	503 with a "Retry-After" 30 seconds on, as an HTTP date,
+#		in GMT, "gmt", without a time zone, "naive", or "bad", not a date,
+#		for the first request, then 200
+#	/slow/<seconds>	200 after the seconds
+#	anything else	404
+class Test_Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+
+	def log_message(self, format, *args):
+		return
+
+	def respond(self, code, headers={}, body=b""):
+		with self.server.lock:
+			self.server.requests.append((self.command, self.path))
+		self.send_response(code)
+		for key, val in headers.items():
+			self.send_header(key, val)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if self.command != "HEAD":
+			self.wfile.write(body)
+
+	def do_HEAD(self):
+		parts = self.path.split("/")
+		if len(parts) == 3 and parts[1] == "status":
+			return self.respond(int(parts[2]))
+		if len(parts) == 3 and parts[1] == "redirect":
+			n = int(parts[2])
+			location = f"{n - 1}" if n > 0 else "/status/200"
+			return self.respond(301, {"Location": location})
+		if self.path == "/loop":
+			return self.respond(302, {"Location": self.path})
+		if self.path == "/no-head":
+			return self.respond(405)
+		if self.path == "/no-range":
+			return self.respond(403)
+		if len(parts) == 3 and parts[1] == "busy":
+			with self.server.lock:
+				seen = [path for _, path in self.server.requests if path == self.path]
+			if len(seen) < int(parts[2]):
+				return self.respond(503, {"Retry-After": "1"})
+			return self.respond(200)
+		if len(parts) == 3 and parts[1] == "busy-date":
+			with self.server.lock:
+				seen = [path for _, path in self.server.requests if path == self.path]
+			if seen:
+				return self.respond(200)
+			when = datetime.datetime.now(datetime.timezone.utc)
+			when += datetime.timedelta(seconds=30)
+			retry_after = {
+					"gmt": email.utils.format_datetime(when, usegmt=True),
+					"naive": email.utils.format_datetime(when.replace(tzinfo=None)),
+					"bad": "soon",
+			}[parts[2]]
+			return self.respond(503, {"Retry-After": retry_after})
+		if len(parts) == 3 and parts[1] == "slow":
+			time.sleep(float(parts[2]))
+			return self.respond(200)
+		return self.respond(404)
+
+	def do_GET(self):
+		page = b"<html>" + (b" " * 100000) + b"</html>"
+		if self.path == "/no-head":
+			if self.headers.get("Range") == "bytes=0-0":
+				headers = {"Content-Range": f"bytes 0-0/{len(page)}"}
+				return self.respond(206, headers, page[0:1])
+			return self.respond(200, {}, page)
+		if self.path == "/no-range":
+			return self.respond(200, {}, page)
+		return self.do_HEAD()
+
+
+class Test_Server(http.server.ThreadingHTTPServer):
+
+	# URLs of 127.0.0.1 are ignored when found in files, thus the URLs of a
+	# server in a test repository need another of the loopback addresses
+	def __init__(self, host="127.0.0.1"):
+		super().__init__((host, 0), Test_Handler)
+		self.lock = threading.Lock()
+		self.connections = 0
+		self.requests = []
+		self.url = f"http://{host}:{self.server_address[1]}"
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+	# clients may close the connection without reading the body
+	def handle_error(self, request, client_address):
+		return
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self, *args):
+		self.shutdown()
+		self.server_close()
+
+
+# the system context, e.g.: so that the phases switch the profiles,
+# without the output
+class Quiet_Context(uc.System_Context):
+
+	def log(self, *args, **kwargs):
+		return
+
+
+class Unused_Reader:
+	repo_dir = "."
+
+	def read(self, blob):
+		raise AssertionError(f"unexpected read of {blob}")
+
+
 class Test_Context:
 
 	def __init__(self, capture=False, verbose=False, dry_run=False):
@@ -26,6 +212,34 @@ class Test_Context:
 		self.now_time = ""
 		self.verbose = verbose
 		self.dry_run = dry_run
+		self.extract = "files"
+		self.results_format = "json"
+		self.extract_cache = None
+		self.sync_jobs = 8
+		self.concurrency = 100
+		self.per_host = 4
+		self.per_host_rate = 0
+		self.public_suffix_list = uc.default_public_suffix_list
+		self.sessions = None
+		self.redirect_cache = None
+		self.strategies = {}
+		self.freshness = {}
+		self.breaker = None
+		self.max_retry_after = 30
+		self.slept = []
+		self.dns_cache = None
+		self.hosts = None
+		self.timings = None
+		self.latencies = None
+		self.profiler = None
+		self.shard = None
+		self.deadline = None
+		self.checkpoint = None
+		self.checkpoint_interval = 60
+		self.clock = 0.0
+		self.incremental = False
+		self.repo_commits = None
+		self.previous_commits = {}
 		self.capture = capture
 		self.out = ''
 
@@ -36,6 +250,31 @@ class Test_Context:
 		fraction = 100000 + self.now_calls
 		return "2023-03-13 14:00:00." + str(fraction)
 
+	def sleep(self, seconds):
+		self.slept.append(seconds)
+
+	# time stands still, unless a test moves the clock,
+	# so that latencies are predictable
+	def monotonic(self):
+		return self.clock
+
+	# counts the times each phase is entered
+	@contextlib.contextmanager
+	def phase(self, name):
+		yield
+		if self.timings is None:
+			self.timings = {}
+		self.timings[name] = self.timings.get(name, 0) + 1
+
+	# if hosts are set, a stub resolver: the addresses or an error code
+	def resolve(self, host):
+		if self.hosts is None:
+			return [info[4][0] for info in socket.getaddrinfo(host, None)]
+		addresses = self.hosts.get(host, socket.EAI_NONAME)
+		if isinstance(addresses, int):
+			raise socket.gaierror(addresses, "stub resolver")
+		return addresses
+
 	# ignore log statements unless capture is set
 	def log(self, *args, **kwargs):
 		if (self.capture):
@@ -52,6 +291,14 @@ class Test_Context:
 			return self.log(args, kwargs)
 
 
+# stops, as on an interrupt, when the daemon pauses between batches
+class Stopping_Context(Test_Context):
+
+	def sleep(self, seconds):
+		super().sleep(seconds)
+		raise KeyboardInterrupt()
+
+
 class Test_url_check(unittest.TestCase):
 
 	def test_system_context(self):
@@ -114,6 +361,50 @@ class Test_url_check(unittest.TestCase):
 		self.assertIn('https://example.com/' + 'two.html', found)
 		self.assertIn('https://example.com/' + 'three.html', found)
 
+	def test_urls_from_bytes(self):
+		data = b"""
+See (https://example.org/a_(b)), or https://example.org/c.
+<a href="http://example.org/d">d</a> and 'https://example.org/e'
+Also http://localhost:4000/ https://web.archive.org/x \xff\xfe
+Skip https://twitter.com/foo but keep (https://example.org/f#g
+Twice: https://example.org/c. and
+"""
+		ignores = ['^http[s]\\?://twitter\\.com']
+		found = uc.urls_from_bytes(data, [], ignores)
+		expected = [
+				"http://example.org/d",
+				"https://example.org/a_(b)",
+				"https://example.org/c.",
+				"https://example.org/e",
+				"https://example.org/f#g",
+		]
+		self.assertEqual(found, expected)
+
+		transforms = ["sed 's@\\.$@@'"]
+		found = uc.urls_from_bytes(data, transforms, ignores)
+		self.assertIn("https://example.org/c", found)
+		self.assertNotIn("https://example.org/c.", found)
+
+		self.assertEqual(uc.urls_from_bytes(b"no links", transforms), [])
+
+	def test_urls_from_missing_file(self):
+		ctx = Test_Context()
+		found = uc.urls_from(".", "no-such-file.md", [], [], ctx)
+		self.assertEqual(found, [])
+
+	def test_regex_from_grep_pattern(self):
+		bre = '^http[s]\\?://github\\.com/.*/edit/'
+		self.assertEqual(
+				uc.regex_from_grep_pattern(bre), '^http[s]?://github\\.com/.*/edit/')
+		bre = '^https://x.org/(a)?b+|c{2}'
+		self.assertEqual(
+				uc.regex_from_grep_pattern(bre),
+				'^https://x.org/\\(a\\)\\?b\\+\\|c\\{2\\}')
+		bre = 'a\\(b\\|c\\)\\{2\\}\\<'
+		self.assertEqual(uc.regex_from_grep_pattern(bre), 'a(b|c){2}\\b')
+		bre = '[^]a[:space:]\\[:x'
+		self.assertEqual(uc.regex_from_grep_pattern(bre), '[^\\]a\\s\\\\\\[:x]')
+
 	def test_clear_previous_used(self):
 		name1 = "blog.example.net"
 		name2 = "blog.example.eu"
@@ -160,6 +451,294 @@ class Test_url_check(unittest.TestCase):
 		bogus_used = checks["http://bogus.gov"]["used"]
 		self.assertIn(file, bogus_used[name])
 
+	def test_set_used_git_grep(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		name = "grep-test"
+		files = {
+				"a.md": b"[a](https://example.org/a) https://example.org/b.",
+				"b/c.md": b"(https://example.org/c), http://localhost/",
+				"d.html": b"<a href='https://example.org/a'>a</a>",
+				"e.bin": b"\0\1\2 https://example.net/bin",
+				"ignored.md": b"https://example.org/ignored",
+		}
+		make_test_repo(os.path.join(gits_dir, name), files)
+		files = ["a.md", "b/c.md", "d.html", "e.bin"]
+		ignore = ['^http[s]\\?://example.org/b']
+		transforms = ["sed 's@/a$@/A@'"]
+
+		ctx = Test_Context()
+		ctx.extract = "git-grep"
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files, ignore, transforms, ctx)
+		# transforms are applied before the parens are removed
+		expected = [
+				"https://example.org/A",
+				"https://example.org/a",
+				"https://example.org/c",
+		]
+		self.assertEqual(sorted(checks.keys()), expected)
+		self.assertEqual(checks[expected[0]]["used"][name], ["d.html"])
+		self.assertEqual(checks[expected[1]]["used"][name], ["a.md"])
+
+		# a transform which drops lines can not be mapped back
+		transforms = ["grep -v 'example.org/c'"]
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files, ignore, transforms, ctx)
+		self.assertEqual(sorted(checks.keys()), ["https://example.org/a"])
+
+		# binary files are only scanned in "files" mode
+		ctx.extract = "files"
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files, ignore, [], ctx)
+		self.assertIn("https://example.net/bin", checks)
+
+		# not a git repository, falls back to scanning the files
+		ctx.extract = "git-grep"
+		self.assertIsNone(
+				uc.urls_by_file_from_git_grep(gits_dir, files, [], [], ctx))
+		checks = {}
+		uc.set_used(checks, os.path.join(gits_dir, name), "b", ["c.md"], [], [],
+				ctx)
+		self.assertEqual(list(checks.keys()), ["https://example.org/c"])
+
+	def test_read_repos_files_blobs(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		origin = make_test_repo(
+				"/tmp/url-check-tests/origins/blobs-test", {
+				"a.md": b"[a](https://example.org/a)",
+				"docs/b.md": b"https://example.org/b https://example.org/a",
+				"skip.md": b"https://example.org/skip",
+				})
+		repos = {
+				"blobs-test": {
+				"url": origin,
+				"branch": "main",
+				"ignore_files": {
+				"skip.md": "no reason, really"
+				}
+				}
+		}
+		ctx = Test_Context()
+		ctx.extract = "blobs"
+		subprocess.run(["rm", "-rf", uc.bare_repo_dir(gits_dir, "blobs-test")])
+		repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+		files = repos_files["blobs-test"]
+		self.assertEqual(sorted(files.keys()), ["a.md", "docs/b.md"])
+		repo_dir = uc.bare_repo_dir(gits_dir, "blobs-test")
+		self.assertFalse(os.path.exists(os.path.join(repo_dir, "a.md")))
+
+		checks = {}
+		uc.set_used(checks, gits_dir, "blobs-test", files, [], [], ctx)
+		used = checks["https://example.org/a"]["used"]["blobs-test"]
+		self.assertEqual(sorted(used), ["a.md", "docs/b.md"])
+		self.assertNotIn("https://example.org/skip", checks)
+
+		# the existing clone is updated
+		make_test_repo(origin, {"c.md": b"https://example.org/c"})
+		repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+		self.assertEqual(list(repos_files["blobs-test"].keys()), ["c.md"])
+
+		with uc.Git_Blob_Reader(repo_dir, ctx) as reader:
+			self.assertIsNone(reader.read("0" * 40))
+			blob = repos_files["blobs-test"]["c.md"]
+			self.assertEqual(reader.read(blob), b"https://example.org/c")
+
+	def test_read_repos_files_branches(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		origin = make_test_repo(
+				"/tmp/url-check-tests/origins/branches-test", {
+				"a.md": b"https://example.org/a",
+				"b.md": b"https://example.org/b",
+				"skip.md": b"https://example.org/skip",
+				})
+		git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+		with open(os.path.join(origin, "b.md"), "wb") as out_file:
+			out_file.write(b"https://example.org/b1")
+		cmds = [
+				["checkout", "--quiet", "-b", "release-1"],
+				["commit", "--quiet", "--all", "--message=release"],
+				["checkout", "--quiet", "main"],
+		]
+		for cmd in cmds:
+			subprocess.run(git + cmd, cwd=origin, check=True)
+		repos = {
+				"branches-test": {
+				"url": origin,
+				"branches": ["main", "release-1"],
+				"ignore_files": {
+				"skip.md": "no reason, really"
+				}
+				}
+		}
+		subprocess.run(["rm", "-rf", uc.bare_repo_dir(gits_dir, "branches-test")])
+
+		# the branches are read from the object store in any extract mode
+		ctx = Test_Context()
+		ctx.extract_cache = uc.Extract_Cache()
+		ctx.repo_commits = {}
+		repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+		files = repos_files["branches-test"]
+		self.assertEqual(
+				sorted(files.keys()),
+				["main:a.md", "main:b.md", "release-1:a.md", "release-1:b.md"])
+		self.assertEqual(files["main:a.md"], files["release-1:a.md"])
+		self.assertEqual(
+				sorted(ctx.repo_commits["branches-test"].keys()), ["main", "release-1"])
+
+		checks = {}
+		uc.set_used(checks, gits_dir, "branches-test", files, [], [], ctx)
+		# a.md is the same in both branches, and is only read once
+		self.assertEqual(ctx.extract_cache.misses, 3)
+		used = {url: entry["used"]["branches-test"] for url, entry in checks.items()}
+		self.assertEqual(
+				sort_dict_of_lists(used), {
+				"https://example.org/a": ["main:a.md", "release-1:a.md"],
+				"https://example.org/b": ["main:b.md"],
+				"https://example.org/b1": ["release-1:b.md"],
+				})
+
+		# the changes are of each branch, a new branch is extracted in full
+		ctx.previous_commits = ctx.repo_commits
+		ctx.repo_commits = {}
+		with open(os.path.join(origin, "a.md"), "wb") as out_file:
+			out_file.write(b"https://example.org/a2")
+		subprocess.run(
+				git + ["commit", "--quiet", "--all", "--message=a2"],
+				cwd=origin,
+				check=True)
+		uc.read_repos_files(gits_dir, repos, ctx)
+		changed = uc.changed_files_for(gits_dir, "branches-test", ctx)
+		self.assertEqual(changed, {"main:a.md": "M"})
+		ctx.previous_commits = {"branches-test": {"main": "0" * 40}}
+		self.assertIsNone(uc.changed_files_for(gits_dir, "branches-test", ctx))
+
+		# from "branches" back to a "branch", the diff is not attempted
+		ctx.previous_commits = ctx.repo_commits
+		ctx.repo_commits = {
+				"branches-test": ctx.repo_commits["branches-test"]["main"]
+		}
+		real_changed_files = uc.changed_files
+		uc.changed_files = None
+		try:
+			self.assertIsNone(uc.changed_files_for(gits_dir, "branches-test", ctx))
+		finally:
+			uc.changed_files = real_changed_files
+
+	def test_git_blob_id(self):
+		# as from: printf 'foo\n' | git hash-object --stdin
+		blob = "257cc5642cb1a054f08cc83f2d943e56fd3ebe99"
+		self.assertEqual(uc.git_blob_id(b"foo\n"), blob)
+
+	def test_extract_cache(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		name = "cache-test"
+		cache_path = os.path.join(gits_dir, "test-extract-cache.json")
+		subprocess.run(["rm", "-f", cache_path])
+		files = {
+				"a.md": b"https://example.org/a",
+				"b.md": b"https://example.org/b",
+				"c.md": b"https://example.org/a",
+		}
+		make_test_repo(os.path.join(gits_dir, name), files)
+		ignore = ['^http[s]\\?://example.org/b']
+
+		ctx = Test_Context()
+		ctx.extract_cache = uc.Extract_Cache(cache_path)
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files.keys(), ignore, [], ctx)
+		# a.md and c.md have the same contents
+		self.assertEqual(ctx.extract_cache.hits, 1)
+		self.assertEqual(ctx.extract_cache.misses, 2)
+		ctx.extract_cache.save()
+		expected = checks
+
+		ctx.extract_cache = uc.Extract_Cache(cache_path)
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files.keys(), ignore, [], ctx)
+		self.assertEqual(ctx.extract_cache.hits, 3)
+		self.assertEqual(ctx.extract_cache.misses, 0)
+		self.assertEqual(checks, expected)
+
+		# different settings do not use the same entries
+		checks = {}
+		uc.set_used(checks, gits_dir, name, files.keys(), [], [], ctx)
+		self.assertEqual(ctx.extract_cache.misses, 2)
+		self.assertIn("https://example.org/b", checks)
+
+		# only the entries used in the run are saved
+		ctx.extract_cache.save()
+		cached = uc.read_json(cache_path)
+		self.assertEqual(len(cached.keys()), 2)
+
+		# cached blobs are not read
+		ctx.extract = "blobs"
+		ctx.extract_cache = uc.Extract_Cache(cache_path)
+		blobs = {file: uc.git_blob_id(data) for file, data in files.items()}
+		checks = {}
+		for file, blob in blobs.items():
+			uc.set_used_for_file(checks, gits_dir, name, file, ignore, [], ctx, blob,
+					Unused_Reader())
+		self.assertEqual(checks, expected)
+		subprocess.run(["rm", "-f", cache_path])
+
+	def test_read_repos_files_shallow_blobless(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		origin = make_test_repo("/tmp/url-check-tests/origins/sync-test", {
+				"a.md": b"https://example.org/a",
+				"b.md": b"https://example.org/b",
+		})
+		git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+		cmds = [
+				["config", "uploadpack.allowFilter", "true"],
+				["config", "uploadpack.allowAnySHA1InWant", "true"],
+				["commit", "--quiet", "--allow-empty", "--message=second"],
+		]
+		for cmd in cmds:
+			subprocess.run(git + cmd, cwd=origin, check=True)
+		repos = {
+				"sync-test": {
+				"url": "file://" + origin,
+				"branch": "main"
+				},
+				"sync-test-2": {
+				"url": "file://" + origin,
+				"branch": "main",
+				"ignore_files": {
+				"b.md": "no reason, really"
+				}
+				},
+		}
+		for name in repos.keys():
+			subprocess.run(["rm", "-rf", os.path.join(gits_dir, name)])
+			subprocess.run(["rm", "-rf", uc.bare_repo_dir(gits_dir, name)])
+
+		def git_slurp(cmd, repo_dir):
+			return uc.shell_slurp(cmd, repo_dir)
+
+		ctx = Test_Context()
+		ctx.sync_jobs = 2
+		repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+		self.assertEqual(repos_files["sync-test"], ["a.md", "b.md"])
+		self.assertEqual(repos_files["sync-test-2"], ["a.md"])
+		repo_dir = os.path.join(gits_dir, "sync-test")
+		shallow = git_slurp("git rev-parse --is-shallow-repository", repo_dir)
+		self.assertEqual(shallow, "true")
+
+		ctx.extract = "blobs"
+		repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+		repo_dir = uc.bare_repo_dir(gits_dir, "sync-test")
+		missing_cmd = "git rev-list --objects --missing=print --all | grep '^?'"
+		missing = git_slurp(missing_cmd, repo_dir).split()
+		self.assertEqual(len(missing), 2)
+
+		checks = {}
+		files = repos_files["sync-test"]
+		uc.set_used(checks, gits_dir, "sync-test", files, [], [], ctx)
+		self.assertEqual(
+				sorted(checks.keys()),
+				["https://example.org/a", "https://example.org/b"])
+		self.assertEqual(git_slurp(missing_cmd, repo_dir), "")
+
 	def test_sort_by_key(self):
 		stuff = {
 				"a": "foo",
@@ -180,6 +759,235 @@ class Test_url_check(unittest.TestCase):
 		status_code = uc.status_code_for_url("http://bogus.gov", 1)
 		self.assertEqual(status_code, 0)
 
+	def test_status_code_for_url_with_sessions(self):
+		ctx = Test_Context()
+		ctx.sessions = uc.Session_Pool(pool_size=2)
+		with Test_Server() as server:
+			for i in range(5):
+				status_code = uc.status_code_for_url(server.url + "/status/200", 1, ctx)
+				self.assertEqual(status_code, 200)
+			status_code = uc.status_code_for_url(server.url + "/status/500", 1, ctx)
+			self.assertEqual(status_code, 500)
+			# the connection was kept alive and reused
+			self.assertEqual(server.connections, 1)
+
+			ctx.sessions.close()
+			ctx.sessions = uc.Session_Pool(keep_alive=False, retries=2)
+			for i in range(3):
+				uc.status_code_for_url(server.url + "/status/200", 1, ctx)
+			self.assertEqual(server.connections, 4)
+		ctx.sessions.close()
+
+	def test_check_url_redirects(self):
+		ctx = Test_Context()
+		with Test_Server() as server:
+			result = uc.check_url(server.url + "/redirect/2", 1, ctx)
+			self.assertEqual(result["status"], 200)
+			expected = [
+					{
+					"status": 301,
+					"to": server.url + "/redirect/1"
+					},
+					{
+					"status": 301,
+					"to": server.url + "/redirect/0"
+					},
+					{
+					"status": 301,
+					"to": server.url + "/status/200"
+					},
+			]
+			self.assertEqual(result["redirects"], expected)
+
+			result = uc.check_url(server.url + "/loop", 1, ctx)
+			self.assertEqual(result["status"], 0)
+			self.assertEqual(len(result["redirects"]), uc.max_redirects)
+
+			# with a cache, a hop is only fetched once
+			ctx.redirect_cache = {}
+			server.requests = []
+			uc.check_url(server.url + "/redirect/2", 1, ctx)
+			self.assertEqual(len(server.requests), 4)
+			result = uc.check_url(server.url + "/redirect/1", 1, ctx)
+			self.assertEqual(result["redirects"], expected[1:])
+			self.assertEqual(len(server.requests), 5)
+
+			url = server.url + "/redirect/1"
+			checks = {url: {"url": url, "checks": {}, "used": {}}}
+			uc.update_status_code_for_url(url, checks, 1, ctx)
+			self.assertEqual(checks[url]["checks"]["redirects"], expected[1:])
+
+	def test_check_url_strategies(self):
+		ctx = Test_Context()
+		ctx.sessions = uc.Session_Pool()
+		with Test_Server() as server:
+			result = uc.check_url(server.url + "/no-head", 1, ctx)
+			self.assertEqual(result["status"], 200)
+			result = uc.check_url(server.url + "/no-range", 1, ctx)
+			self.assertEqual(result["status"], 200)
+			self.assertEqual(server.requests, [
+					("HEAD", "/no-head"),
+					("GET", "/no-head"),
+					("HEAD", "/no-range"),
+					("GET", "/no-range"),
+			])
+			# the 206 body was read, thus the connection was reused
+			self.assertEqual(server.connections, 1)
+
+			ctx.strategies = {
+					"^http://127\\.0\\.0\\.1:[0-9]*/no-head": "head",
+					"/status/": "get",
+			}
+			server.requests = []
+			result = uc.check_url(server.url + "/no-head", 1, ctx)
+			self.assertEqual(result["status"], 405)
+			result = uc.check_url(server.url + "/status/404", 1, ctx)
+			self.assertEqual(result["status"], 404)
+			self.assertEqual(server.requests, [
+					("HEAD", "/no-head"),
+					("GET", "/status/404"),
+			])
+		ctx.sessions.close()
+
+	def test_check_url_retry_after(self):
+		ctx = Test_Context()
+		ctx.max_retry_after = 0.5
+		with Test_Server() as server:
+			result = uc.check_url(server.url + "/busy/2", 1, ctx)
+			self.assertEqual(result["status"], 200)
+			self.assertEqual(ctx.slept, [0.5, 0.5])
+			result = uc.check_url(server.url + "/busy/5", 1, ctx)
+			self.assertEqual(result["status"], 503)
+			self.assertEqual(len(ctx.slept), 4)
+
+			# an HTTP date, with or without a time zone, is waited for
+			for form in ["gmt", "naive"]:
+				ctx.slept = []
+				result = uc.check_url(server.url + f"/busy-date/{form}", 1, ctx)
+				self.assertEqual(result["status"], 200)
+				self.assertEqual(ctx.slept, [0.5])
+			# but not a value which is neither seconds nor a date
+			ctx.slept = []
+			result = uc.check_url(server.url + "/busy-date/bad", 1, ctx)
+			self.assertEqual(result["status"], 503)
+			self.assertEqual(ctx.slept, [])
+
+	def test_check_url_deadline(self):
+		ctx = Test_Context()
+		ctx.now_time = "2023-04-01 00:00:00.000000"
+		with Test_Server() as server:
+			# the wait for the "Retry-After" would end after the deadline
+			ctx.deadline = 0.5
+			result = uc.check_url(server.url + "/busy/1", 10, ctx)
+			self.assertEqual(result, {"not-reached": True, "redirects": []})
+			self.assertEqual(ctx.slept, [])
+			self.assertEqual(len(server.requests), 1)
+
+			# once the deadline has passed, no request is sent
+			ctx.deadline = 0.0
+			url = server.url + "/status/404"
+			checks = {
+					url: {
+					"checks": {
+					"status": 200,
+					"200": "2023-03-01 00:00:00.0"
+					},
+					"used": {}
+					}
+			}
+			uc.update_status_code_for_url(url, checks, 10, ctx)
+			self.assertEqual(len(server.requests), 1)
+		self.assertEqual(
+				checks[url]["checks"], {
+				"status": 200,
+				"200": "2023-03-01 00:00:00.0",
+				"not-reached": "2023-04-01 00:00:00.000000",
+				})
+
+	def test_check_url_circuit_breaker(self):
+		# nothing is listening on the port of a closed server
+		with Test_Server() as server:
+			down = server.url
+		ctx = Test_Context()
+		ctx.breaker = uc.Circuit_Breaker(2)
+		urls = [down + f"/{i}" for i in range(4)]
+		checks = {url: {"url": url, "checks": {}, "used": {}} for url in urls}
+		for url in urls:
+			uc.update_status_code_for_url(url, checks, 1, ctx)
+		for url in urls[:2]:
+			self.assertEqual(checks[url]["checks"]["status"], 0)
+			self.assertEqual(checks[url]["checks"]["reason"], "ConnectionError")
+		for url in urls[2:]:
+			check = checks[url]["checks"]
+			self.assertEqual(check["status"], uc.circuit_open_status)
+			self.assertIn("circuit open", check["reason"])
+
+		# a response from the host closes the circuit again
+		ctx.breaker = uc.Circuit_Breaker(2)
+		ctx.breaker.record("127.0.0.1", False)
+		with Test_Server() as server:
+			result = uc.check_url(server.url + "/status/200", 1, ctx)
+			self.assertEqual(result, {"status": 200, "redirects": []})
+		self.assertFalse(ctx.breaker.is_open("127.0.0.1"))
+		self.assertEqual(ctx.breaker.errors["127.0.0.1"], 0)
+
+	def test_resolve_hosts(self):
+		ctx = Test_Context()
+		ctx.dns_cache = {}
+		ctx.hosts = {
+				"example.org": ["192.0.2.1", "192.0.2.1", "2001:db8::1"],
+				"busy.example.net": socket.EAI_AGAIN,
+		}
+		urls = [
+				"https://example.org/one",
+				"https://example.org/two",
+				"https://busy.example.net/",
+				"https://no-such.example.com/",
+				"NOT A VALID URL",
+		]
+		missing = uc.resolve_hosts(urls, ctx)
+		self.assertEqual(missing, ["no-such.example.com"])
+		self.assertEqual(ctx.dns_cache, {
+				"example.org": ["192.0.2.1", "2001:db8::1"],
+				"no-such.example.com": None,
+		})
+
+		# the URLs of a host which does not exist fail without a request
+		checks = {url: {"url": url, "checks": {}, "used": {}} for url in urls}
+		url = "https://no-such.example.com/"
+		uc.update_status_code_for_url(url, checks, 1, ctx)
+		self.assertEqual(checks[url]["checks"]["status"], 0)
+		self.assertEqual(checks[url]["checks"]["reason"], "NXDOMAIN")
+
+		# the cached hosts are not looked up again
+		ctx.hosts = {}
+		self.assertEqual(uc.resolve_hosts(urls[:2], ctx), [])
+		self.assertEqual(ctx.dns_cache["example.org"], ["192.0.2.1", "2001:db8::1"])
+
+	def test_status_code_for_url_redirects(self):
+		with Test_Server() as server:
+			status_code = uc.status_code_for_url(server.url + "/redirect/1", 1)
+		self.assertEqual(status_code, 200)
+
+	def test_session_pool(self):
+		sessions = uc.Session_Pool(pool_size=3, retries=1)
+		one = sessions.session_for("https://example.org/one")
+		two = sessions.session_for("https://EXAMPLE.org/two")
+		other = sessions.session_for("https://example.net/")
+		self.assertIs(one, two)
+		self.assertIsNot(one, other)
+		adapter = one.get_adapter("https://example.org/")
+		self.assertEqual(adapter.max_retries.total, 1)
+		self.assertEqual(adapter._pool_maxsize, 3)
+		# a redirect to another scheme or host keeps the pool of the host
+		manager = adapter.poolmanager
+		pool = manager.connection_from_url("http://example.org/")
+		manager.connection_from_url("https://example.org/")
+		manager.connection_from_url("https://www.example.org/")
+		self.assertIs(manager.connection_from_url("http://example.org/"), pool)
+		sessions.close()
+		self.assertEqual(sessions.sessions, {})
+
 	def test_read_and_write_json(self):
 		json_file = "test-obj.json"
 		subprocess.run(["rm", "-f", json_file])
@@ -192,6 +1000,121 @@ class Test_url_check(unittest.TestCase):
 		self.assertEqual(round_trip, obj)
 		subprocess.run(["rm", "-f", json_file])
 
+	def test_read_and_write_jsonl(self):
+		jsonl_file = "/tmp/url-check-tests/test-results.jsonl"
+		checks = {
+				"https://example.org/": {
+				"url": "https://example.org/",
+				"checks": {
+				"status": 200
+				},
+				"used": {
+				"a": ["x.md"]
+				},
+				},
+				"https://example.net/": {
+				"url": "https://example.net/",
+				"checks": {
+				"status": 404
+				},
+				"used": {
+				"b": ["y.md"]
+				},
+				},
+		}
+		uc.write_results(jsonl_file, checks, "jsonl")
+		with open(jsonl_file, "r") as in_file:
+			lines = in_file.read().splitlines()
+		self.assertEqual(len(lines), 2)
+		self.assertEqual(json.loads(lines[0])["url"], "https://example.net/")
+		self.assertTrue(uc.is_jsonl_file(jsonl_file))
+		self.assertEqual(uc.read_results(jsonl_file), checks)
+
+		condensed = uc.condense_results(checks, ["a", "b"])
+		uc.write_results(jsonl_file, condensed, "jsonl")
+		self.assertEqual(uc.read_results(jsonl_file), condensed)
+
+		# the same path may hold either format
+		uc.write_results(jsonl_file, checks, "json")
+		self.assertFalse(uc.is_jsonl_file(jsonl_file))
+		self.assertEqual(uc.read_results(jsonl_file), checks)
+		subprocess.run(["rm", "-f", jsonl_file])
+		self.assertEqual(uc.read_results(jsonl_file), {})
+
+		# a run without URLs writes an empty file, as does a blank line
+		uc.write_results(jsonl_file, {}, "jsonl")
+		self.assertEqual(uc.read_results(jsonl_file), {})
+		with open(jsonl_file, "w") as out_file:
+			out_file.write("\n  \n")
+		self.assertEqual(uc.read_results(jsonl_file), {})
+		subprocess.run(["rm", "-f", jsonl_file])
+
+	def test_sqlite_store(self):
+		db_path = "/tmp/url-check-tests/test-results.sqlite"
+		subprocess.run(["rm", "-f", db_path])
+		self.assertTrue(uc.is_sqlite_path(db_path))
+		self.assertFalse(uc.is_sqlite_path("url-check-results.json"))
+		checks = {
+				"https://example.org/": {
+				"url": "https://example.org/",
+				"checks": {
+				"status": 200,
+				"200": "2023-04-01 00:00:00.000000"
+				},
+				"used": {
+				"foo": ["a.md", "b.md"],
+				"bar": ["c.md"]
+				}
+				},
+				"https://example.org/bad": {
+				"url": "https://example.org/bad",
+				"checks": {
+				"status": 404,
+				"fail": {
+				"from": "2023-04-01 00:00:00.000000",
+				"from-code": 404
+				}
+				},
+				"used": {
+				"foo": ["a.md"]
+				}
+				},
+		}
+		store = uc.Sqlite_Store(db_path)
+		self.assertEqual(store.load(), {})
+		store.save(checks)
+		self.assertEqual(uc.Sqlite_Store(db_path).load(), checks)
+
+		store = uc.Sqlite_Store(db_path)
+		checks = store.load()
+		bad = checks["https://example.org/bad"]
+		uc.update_status(bad["checks"], 404, "2023-04-02 00:00:00.000000",
+				Test_Context())
+		checks["https://example.org/"]["used"]["foo"] = ["a.md"]
+		checks["https://example.org/new"] = {
+				"url": "https://example.org/new",
+				"checks": {},
+				"used": {
+				"bar": ["c.md"]
+				}
+		}
+		store.save(checks)
+		self.assertEqual(uc.Sqlite_Store(db_path).load(), checks)
+
+		checks.pop("https://example.org/new")
+		store.save(checks)
+		self.assertEqual(uc.Sqlite_Store(db_path).load(), checks)
+
+		db = sqlite3.connect(db_path)
+		history = list(db.execute("SELECT * FROM history ORDER BY checked"))
+		db.close()
+		self.assertEqual(history, [
+				("https://example.org/", "2023-04-01 00:00:00.000000", 200),
+				("https://example.org/bad", "2023-04-01 00:00:00.000000", 404),
+				("https://example.org/bad", "2023-04-02 00:00:00.000000", 404),
+		])
+		subprocess.run(["rm", "-f", db_path])
+
 	def test_shell_slurp(self):
 		cmd = "echo 'foo'; echo 'bar'"
 		stuff = uc.shell_slurp(cmd).splitlines()
@@ -330,7 +1253,9 @@ class Test_url_check(unittest.TestCase):
 				"url": "https://example.net/",
 				"checks": {
 				"status": 200,
-				"200": "2023-04-01 00:00:00.000000"
+				"200": "2023-04-01 00:00:00.000000",
+				"latency": 0.0,
+				"outcome": "passed"
 				},
 				"used": {
 				"test-data": ["foo.md"]
@@ -340,7 +1265,9 @@ class Test_url_check(unittest.TestCase):
 				"url": "https://example.org/",
 				"checks": {
 				"status": 200,
-				"200": "2023-04-01 00:00:00.000000"
+				"200": "2023-04-01 00:00:00.000000",
+				"latency": 0.0,
+				"outcome": "passed"
 				},
 				"used": {
 				"test-data": ["foo.md"]
@@ -355,7 +1282,10 @@ class Test_url_check(unittest.TestCase):
 				"from-code": 404,
 				"to": "2023-04-01 00:00:00.000000",
 				"to-code": 0
-				}
+				},
+				"reason": "ConnectionError",
+				"latency": 0.0,
+				"outcome": "error"
 				},
 				"used": {
 				"test-data": ["foo.md"]
@@ -369,7 +1299,10 @@ class Test_url_check(unittest.TestCase):
 				"fail": {
 				"from": "2023-04-01 00:00:00.000000",
 				"from-code": 0
-				}
+				},
+				"reason": "ConnectionError",
+				"latency": 0.0,
+				"outcome": "error"
 				},
 				"used": {
 				"test-data": ["foo.md"]
@@ -385,6 +1318,7 @@ class Test_url_check(unittest.TestCase):
 				transforms, ctx)
 		self.maxDiff = None
 		self.assertEqual(checks, expected)
+		self.assertEqual(ctx.timings, {"extract": 1, "check": 1})
 
 		# remove the passes from the checks to create condensed results
 		expected.pop("https://example.net/")
@@ -401,40 +1335,974 @@ class Test_url_check(unittest.TestCase):
 		condensed = uc.condense_results(checks, repos)
 		self.assertEqual(condensed, expected_condensed)
 
-	def test_group_by_second_level_domain(self):
+	def test_write_metrics(self):
+		metrics_path = "/tmp/url-check-tests/url-check.prom"
+		checks = {}
+		for i in range(10):
+			url = f"https://example.org/{i}"
+			check = {"status": 200, "latency": (i + 1) / 10, "outcome": "passed"}
+			checks[url] = {"url": url, "checks": check, "used": {}}
+		url = "https://example.net/"
+		check = {"status": -2, "latency": 0.0, "outcome": "skipped"}
+		checks[url] = {"url": url, "checks": check, "used": {}}
+		url = "https://www.example.net/x"
+		check = {"status": 404, "latency": 0.25, "outcome": "failed"}
+		checks[url] = {"url": url, "checks": check, "used": {}}
+
+		# checked in an earlier run, e.g.: skipped as fresh
+		url = "https://example.com/"
+		check = {"status": 200, "latency": 9.0, "outcome": "skipped"}
+		checks[url] = {"url": url, "checks": check, "used": {}}
+
+		ctx = Test_Context()
+		ctx.timings = {"sync": 1.5, "check": 2.25}
+		ctx.latencies = {}
+		for url, entry in checks.items():
+			check = entry["checks"]
+			if check["outcome"] != "skipped":
+				ctx.latencies[url] = check["latency"]
+		uc.write_metrics(metrics_path, checks, ctx)
+		with open(metrics_path, "r") as in_file:
+			lines = in_file.read().splitlines()
+		self.assertFalse(os.path.exists(metrics_path + ".tmp"))
+
+		for line in [
+				'url_check_phase_seconds{phase="sync"} 1.500',
+				'url_check_phase_seconds{phase="check"} 2.250',
+				'url_check_urls{status="200"} 11',
+				'url_check_urls{status="404"} 1',
+				'url_check_urls{status="-2"} 1',
+				'url_check_host_latency_seconds{host="example.org",quantile="0.5"} 0.500',
+				'url_check_host_latency_seconds{host="example.org",quantile="0.95"} 1.000',
+				'url_check_host_latency_seconds{host="www.example.net",quantile="0.5"} 0.250',
+		]:
+			self.assertIn(line, lines)
+		# skipped URLs were not checked, there is no latency for the host
+		self.assertEqual([line for line in lines if '"example.net"' in line], [])
+		self.assertEqual([line for line in lines if '"example.com"' in line], [])
+
+		# a URL is timed once, whatever the number of its variants
+		ctx = Test_Context()
+		ctx.dry_run = True
+		ctx.latencies = {}
+		variants = ["https://example.org/v", "https://example.org/v#a"]
+		checks = {url: {"url": url, "checks": {}, "used": {}} for url in variants}
+		uc.update_status_code_for_url(variants[0], checks, 1, ctx, variants)
+		self.assertEqual(ctx.latencies, {})
+		ctx.dry_run = False
+		real_check_url = uc.check_url
+		uc.check_url = lambda url, timeout, ctx=None: {
+				"status": 200,
+				"redirects": []
+		}
+		try:
+			uc.update_status_code_for_url(variants[0], checks, 1, ctx, variants)
+		finally:
+			uc.check_url = real_check_url
+		self.assertEqual(ctx.latencies, {"https://example.org/v": 0.0})
+		self.assertEqual(uc.percentile([3, 1, 2], 0.5), 2)
+
+	def test_profiler(self):
+		profile_dir = "/tmp/url-check-tests/profile"
+		subprocess.run(["rm", "-rf", profile_dir])
+		ctx = Test_Context()
+		ctx.profiler = uc.Profiler(profile_dir)
+
+		def busy_worker(n):
+			return sum(i * i for i in range(n))
+
+		ctx.profiler.enter("check")
+		with concurrent.futures.ThreadPoolExecutor(2) as executor:
+			list(executor.map(uc.profiled(busy_worker, ctx), [1000] * 4))
+		ctx.profiler.enter("main")
+		ctx.profiler.save({"check": 0.5})
+
+		self.assertEqual(
+				sorted(os.listdir(profile_dir)),
+				["all.pstats", "check.pstats", "main.pstats", "summary.txt"])
+		stats = pstats.Stats(os.path.join(profile_dir, "check.pstats"))
+		calls = {func[2]: stat[1] for func, stat in stats.stats.items()}
+		self.assertEqual(calls["busy_worker"], 4)
+		with open(os.path.join(profile_dir, "summary.txt"), "r") as in_file:
+			summary = in_file.read()
+		self.assertIn("phase check: 0.500 seconds", summary)
+		self.assertIn("busy_worker", summary)
+
+		# the phases of the system context switch the profiles
+		subprocess.run(["rm", "-rf", profile_dir])
+		system_ctx = uc.System_Context()
+		system_ctx.profiler = uc.Profiler(profile_dir)
+		with system_ctx.phase("check"):
+			with concurrent.futures.ThreadPoolExecutor(2) as executor:
+				list(executor.map(uc.profiled(busy_worker, system_ctx), [1000] * 3))
+		with system_ctx.phase("report"):
+			busy_worker(10)
+		self.assertEqual(system_ctx.profiler.phase, "main")
+		system_ctx.profiler.save(system_ctx.timings)
+		for phase, count in [("check", 3), ("report", 1)]:
+			stats = pstats.Stats(os.path.join(profile_dir, f"{phase}.pstats"))
+			calls = {func[2]: stat[1] for func, stat in stats.stats.items()}
+			self.assertEqual(calls["busy_worker"], count)
+		with open(os.path.join(profile_dir, "summary.txt"), "r") as in_file:
+			summary = in_file.read()
+		self.assertIn("phase report: ", summary)
+
+		ctx.profiler = None
+		self.assertIs(uc.profiled(busy_worker, ctx), busy_worker)
+
+	def test_shards(self):
+		ctx = Test_Context()
+		self.assertEqual(uc.parse_shard("2/4"), (2, 4))
+		self.assertRaises(ValueError, uc.parse_shard, "5/4")
+		urls = [f"https://site{i}.example.org/" for i in range(20)]
+		urls += [f"https://example{i}.net/page" for i in range(20)]
+		urls += [f"https://www.example{i}.net/other" for i in range(20)]
+
+		shards = []
+		for index in [1, 2, 3]:
+			ctx.shard = (index, 3)
+			shards.append(uc.shard_urls(urls, ctx))
+		# every URL is in just one shard, and a site is all in the same shard
+		self.assertEqual(sorted(sum(shards, [])), sorted(urls))
+		self.assertTrue(all(shards))
+		self.assertIn(urls[0], shards[uc.shard_of_url(urls[1], 3, ctx) - 1])
+		for i in range(20, 40):
+			shard = uc.shard_of_url(urls[i], 3, ctx)
+			self.assertEqual(shard, uc.shard_of_url(urls[i + 20], 3, ctx))
+
+	def test_merge_results(self):
+		old = "https://example.org/old"
+		bad = "https://example.net/bad"
+		good = "https://example.com/"
+		before = {
+				old: {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-01 00:00:00.0"
+				}
+				},
+				bad: {
+				"checks": {
+				"status": 404,
+				"fail": {
+				"from": "2023-03-01 00:00:00.0",
+				"from-code": 404
+				},
+				}
+				},
+				good: {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-01 00:00:00.0"
+				}
+				},
+		}
+		one = json.loads(json.dumps(before))
+		two = json.loads(json.dumps(before))
+		# shard one checked the bad URL, shard two the good one
+		one[bad]["checks"]["fail"]["to"] = "2023-04-01 00:00:00.0"
+		one[bad]["checks"]["fail"]["to-code"] = 500
+		two[good]["checks"]["200"] = "2023-04-01 00:00:01.0"
+
+		merged = uc.merge_results([one, two])
+		self.assertEqual(list(merged.keys()), sorted(before.keys()))
+		self.assertEqual(merged[old], before[old])
+		self.assertEqual(
+				merged[bad]["checks"]["fail"], {
+				"from": "2023-03-01 00:00:00.0",
+				"from-code": 404,
+				"to": "2023-04-01 00:00:00.0",
+				"to-code": 500,
+				})
+		self.assertEqual(merged[good], two[good])
+
+	def test_check_url_deadline_mid_request(self):
+		ctx = Test_Context()
+		ctx.monotonic = time.monotonic
+		ctx.breaker = uc.Circuit_Breaker(1)
+		with Test_Server() as server:
+			url = server.url + "/slow/2"
+			# the timeout is cut short by the deadline, not the host
+			# being down, thus the breaker does not count it
+			ctx.deadline = time.monotonic() + 0.2
+			result = uc.check_url(url, 10, ctx)
+			self.assertEqual(result, {"not-reached": True, "redirects": []})
+			self.assertFalse(ctx.breaker.is_open("127.0.0.1"))
+
+			# whereas a timeout without a deadline does count
+			ctx.deadline = None
+			result = uc.check_url(url, 0.2, ctx)
+			self.assertEqual(result["reason"], "ReadTimeout")
+			self.assertTrue(ctx.breaker.is_open("127.0.0.1"))
+
+	def test_main_deadline(self):
+		test_dir = "/tmp/url-check-tests/main-deadline"
+		with Test_Server("127.0.0.2") as server:
+			urls = [server.url + "/status/200", server.url + "/status/404"]
+			argv = make_test_config(test_dir,
+					{"deadline-test": {
+					"a.md": " ".join(urls).encode("utf-8")
+					}})
+			with working_directory(test_dir):
+				ctx = Quiet_Context()
+				started = time.monotonic()
+				uc.main(argv + ["--deadline=60"], ctx)
+				checked = len(server.requests)
+				# too short a deadline for a check of the timeout to start
+				uc.main(argv + ["--deadline=1"], Quiet_Context())
+			requested = len(server.requests)
+
+		# the deadline leaves a share of the time for the reports
+		self.assertAlmostEqual(
+				ctx.deadline - started, 60 * (1 - uc.deadline_report_share), delta=1)
+		self.assertEqual(requested, checked)
+		# the URLs not reached keep their previous status
+		checks = uc.read_results(os.path.join(test_dir, "results.json"))
+		for url, status in zip(urls, [200, 404]):
+			self.assertEqual(checks[url]["checks"]["status"], status)
+			self.assertIn("not-reached", checks[url]["checks"])
+		fails = uc.read_results(os.path.join(test_dir, "url-check-fails.json"))
+		self.assertEqual(sorted(fails["urls"].keys()), urls)
+		self.assertEqual(fails["repos"], {"deadline-test": "failing"})
+
+	def test_deadline_and_checkpoints(self):
+		ctx = Test_Context()
+		ctx.now_time = "2023-04-01 00:00:00.000000"
+		ctx.concurrency = 1
+		ctx.per_host = 1
+		checks = {
+				"https://example.org/passing-new": {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-30 00:00:00.0"
+				}
+				},
+				"https://example.org/passing-old": {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-01 00:00:00.0"
+				}
+				},
+				"https://example.org/failing": {
+				"checks": {
+				"status": 404,
+				"fail": {
+				"from": "2023-03-31 00:00:00.0",
+				"from-code": 404
+				}
+				}
+				},
+				"https://example.org/new": {
+				"checks": {}
+				},
+		}
+		for url in checks:
+			checks[url]["used"] = {"repo": ["file.md"]}
+		urls = list(checks.keys())
+		checked = []
+		snapshots = []
+
+		def fake_check_url(url, timeout, ctx=None):
+			checked.append(url)
+			time.sleep(0.05)
+			ctx.clock += 1
+			return {"status": 200, "redirects": []}
+
+		# one check every second, and a timeout of one second,
+		# thus three checks start before a deadline of 3.5 seconds
+		ctx.deadline = 3.5
+		ctx.checkpoint = snapshots.append
+		ctx.checkpoint_interval = 0.01
+		real_check_url = uc.check_url
+		uc.check_url = fake_check_url
+		try:
+			asyncio.run(uc.update_status_codes_async(urls, checks, 1, ctx))
+		finally:
+			uc.check_url = real_check_url
+
+		self.assertEqual(checked, [
+				"https://example.org/new",
+				"https://example.org/failing",
+				"https://example.org/passing-old",
+		])
+		late = checks["https://example.org/passing-new"]["checks"]
+		self.assertEqual(
+				late, {
+				"status": 200,
+				"200": "2023-03-30 00:00:00.0",
+				"not-reached": "2023-04-01 00:00:00.000000",
+				})
+		condensed = uc.condense_results(checks, ["repo"])
+		self.assertEqual(condensed["repos"], {"repo": "passing"})
+		self.assertEqual(
+				list(condensed["urls"].keys()), ["https://example.org/passing-new"])
+
+		self.assertGreater(len(snapshots), 0)
+		self.assertIsNot(snapshots[0], checks)
+		self.assertEqual(snapshots[0].keys(), checks.keys())
+
+	def test_incremental(self):
+		gits_dir = "/tmp/url-check-tests/gits"
+		origin = "/tmp/url-check-tests/origins/incremental-test"
+		subprocess.run(["rm", "-rf", gits_dir + "/incremental-test"])
+		make_test_repo(
+				origin, {
+				"a.md": b"https://example.org/a",
+				"b.md": b"https://example.org/b",
+				"c.md": b"https://example.org/c",
+				})
+		repos = {"incremental-test": {"url": origin, "branch": "main"}}
+		ctx = Test_Context()
+		ctx.incremental = True
+		ctx.repo_commits = {}
+		checked = []
+		extracted = []
+
+		def fake_check_url(url, timeout, ctx=None):
+			checked.append(url)
+			return {"status": 200, "redirects": []}
+
+		real_check_url = uc.check_url
+		real_file_bytes = uc.file_bytes
+
+		def file_bytes(workdir, file, ctx=None):
+			extracted.append(file)
+			return real_file_bytes(workdir, file, ctx)
+
+		uc.check_url = fake_check_url
+		uc.file_bytes = file_bytes
+		try:
+			repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+			checks = uc.url_check_all(gits_dir, {}, repos_files, 1, [], [], ctx)
+			self.assertEqual(sorted(extracted), ["a.md", "b.md", "c.md"])
+			self.assertEqual(len(checked), 3)
+
+			# b.md changes, c.md is deleted and d.md added
+			make_test_repo(
+					origin, {
+					"a.md": b"https://example.org/a",
+					"b.md": b"https://example.org/b2 https://example.org/a",
+					"d.md": b"https://example.org/d",
+					})
+			ctx.previous_commits = ctx.repo_commits
+			ctx.repo_commits = {}
+			checked.clear()
+			extracted.clear()
+			repos_files = uc.read_repos_files(gits_dir, repos, ctx)
+			changed = uc.changed_files_for(gits_dir, "incremental-test", ctx)
+			self.assertEqual(changed, {"b.md": "M", "c.md": "D", "d.md": "A"})
+			checks = uc.url_check_all(gits_dir, checks, repos_files, 1, [], [], ctx)
+		finally:
+			uc.check_url = real_check_url
+			uc.file_bytes = real_file_bytes
+
+		self.assertEqual(sorted(extracted), ["b.md", "d.md"])
+		self.assertEqual(
+				sorted(checked), ["https://example.org/b2", "https://example.org/d"])
+		used = {
+				url: entry["used"]["incremental-test"] for url, entry in checks.items()
+		}
+		self.assertEqual(
+				used, {
+				"https://example.org/a": ["a.md", "b.md"],
+				"https://example.org/b2": ["b.md"],
+				"https://example.org/d": ["d.md"],
+				})
+
+		# without the previous commit, all of the files are extracted
+		ctx.previous_commits = {"incremental-test": "0" * 40}
+		self.assertIsNone(uc.changed_files_for(gits_dir, "incremental-test", ctx))
+
+	def test_run_daemon(self):
+		test_dir = "/tmp/url-check-tests/daemon"
+		gits_dir = os.path.join(test_dir, "gits")
+		checks_path = os.path.join(test_dir, "daemon-checks.json")
+		subprocess.run(["rm", "-rf", test_dir])
+		with Test_Server("127.0.0.2") as server, working_directory(test_dir):
+			urls = [server.url + f"/status/{code}" for code in [200, 201, 404]]
+			origin = make_test_repo(
+					os.path.join(test_dir, "origins/daemon-test"),
+					{"a.md": " ".join(urls).encode("utf-8")})
+			repos = {"daemon-test": {"url": origin, "branch": "main"}}
+			ctx = Test_Context()
+			ctx.now_time = "2023-04-01 00:00:00.000000"
+			checks = uc.run_daemon(
+					gits_dir,
+					repos,
+					checks_path,
+					1, [], [],
+					ctx,
+					interval=5,
+					batch=2,
+					cycles=2)
+			requested = [path for _, path in server.requests]
+
+			# a dry run neither checks the URLs nor writes the results
+			written = uc.read_results(checks_path)
+			dry_ctx = Test_Context(dry_run=True)
+			dry_ctx.now_time = "2023-04-02 00:00:00.000000"
+			uc.run_daemon(gits_dir, repos, checks_path, 1, [], [], dry_ctx, cycles=1)
+			self.assertEqual(len(server.requests), len(requested))
+			self.assertEqual(uc.read_results(checks_path), written)
+
+		# the new URLs first, then the least recently checked,
+		# here checked at the same time, the failing before the passing
+		self.assertEqual(sorted(requested[0:2]), ["/status/200", "/status/201"])
+		self.assertEqual(
+				sorted(requested[2:5]), ["/status/201", "/status/404", "/status/404"])
+		self.assertEqual(len(requested), 5)
+		self.assertEqual(ctx.slept, [5])
+		self.assertEqual(ctx.timings["sync"], 1)
+		self.assertEqual(ctx.timings["check"], 2)
+		self.assertEqual(uc.read_results(checks_path), checks)
+		self.assertEqual(checks[urls[2]]["checks"]["status"], 404)
+		# the reports are written to the current directory
+		fails = uc.read_results(os.path.join(test_dir, "url-check-fails.json"))
+		self.assertEqual(fails["repos"], {"daemon-test": "failing"})
+
+	def test_run_daemon_resync(self):
+		test_dir = "/tmp/url-check-tests/daemon-resync"
+		gits_dir = os.path.join(test_dir, "gits")
+		checks_path = os.path.join(test_dir, "daemon-checks.json")
+		cache_path = os.path.join(test_dir, "extract-cache.json")
+		subprocess.run(["rm", "-rf", test_dir])
+		with Test_Server("127.0.0.2") as server, working_directory(test_dir):
+			url = server.url + "/status/200"
+			origin = make_test_repo(
+					os.path.join(test_dir, "origins/resync-test"),
+					{"a.md": url.encode("utf-8")})
+			repos = {"resync-test": {"url": origin, "branch": "main"}}
+			ctx = Test_Context()
+			ctx.now_time = "2023-04-01 00:00:00.000000"
+			ctx.extract_cache = uc.Extract_Cache(cache_path)
+			# stale entries, e.g.: from before a host was fixed
+			ctx.redirect_cache = {"http://stale.example/": None}
+			ctx.dns_cache = {"stale.example": None}
+			ctx.breaker = uc.Circuit_Breaker(1)
+			ctx.breaker.record("127.0.0.2", False)
+			checks = uc.run_daemon(
+					gits_dir,
+					repos,
+					checks_path,
+					1, [], [],
+					ctx,
+					interval=5,
+					batch=1,
+					resync_seconds=0,
+					cycles=2)
+
+		# synced every cycle, each time resetting the caches
+		self.assertEqual(ctx.timings["sync"], 2)
+		self.assertNotIn("http://stale.example/", ctx.redirect_cache)
+		self.assertNotIn("stale.example", ctx.dns_cache)
+		# the reset breaker let the URL be checked
+		self.assertFalse(ctx.breaker.is_open("127.0.0.2"))
+		self.assertEqual(checks[url]["checks"]["status"], 200)
+		# the second sync extracted from the entries used by the first
+		self.assertEqual(ctx.extract_cache.hits, 1)
+		self.assertEqual(uc.read_json(cache_path), ctx.extract_cache.cached)
+		self.assertEqual(ctx.extract_cache.used, {})
+
+	def test_main_daemon(self):
+		test_dir = "/tmp/url-check-tests/main-daemon"
+		with Test_Server("127.0.0.2") as server:
+			urls = [server.url + f"/status/{code}" for code in [200, 404]]
+			argv = make_test_config(test_dir,
+					{"daemon-test": {
+					"a.md": " ".join(urls).encode("utf-8")
+					}})
+			argv = argv[0:1] + ["daemon"] + argv[1:]
+			ctx = Stopping_Context(capture=True)
+			with working_directory(test_dir):
+				uc.main(argv + ["--interval=5", "--batch=1"], ctx)
+			requested = server.requests
+
+		# stopped in the pause after the first batch
+		self.assertIn(" stopped\n", ctx.out)
+		self.assertEqual(ctx.slept, [5])
+		self.assertEqual(len(requested), 1)
+		checks = uc.read_results(os.path.join(test_dir, "results.json"))
+		statuses = [check["checks"].get("status") for check in checks.values()]
+		self.assertEqual(sorted(statuses, key=str), [200, None])
+		self.assertTrue(
+				os.path.exists(os.path.join(test_dir, "daemon-test-results.json")))
+
+	def test_update_status_codes_async(self):
+		lock = threading.Lock()
+		in_flight = {}
+		most = {}
+
+		def fake_check_url(url, timeout, ctx=None):
+			host = url.split("/")[2].replace("www.", "")
+			with lock:
+				in_flight[host] = in_flight.get(host, 0) + 1
+				total = sum(in_flight.values())
+				most[host] = max(most.get(host, 0), in_flight[host])
+				most[""] = max(most.get("", 0), total)
+			time.sleep(0.05)
+			with lock:
+				in_flight[host] -= 1
+			status = 404 if url.endswith("/bad") else 200
+			return {"status": status, "redirects": []}
+
+		urls = [f"https://www.example.org/{i}" for i in range(10)]
+		urls += [f"https://example.net/{i}" for i in range(10)]
+		urls += ["https://example.com/bad"]
+		checks = {url: {"url": url, "checks": {}, "used": {}} for url in urls}
+
+		ctx = Test_Context()
+		ctx.now_time = "2023-04-01 00:00:00.000000"
+		ctx.concurrency = 5
+		ctx.per_host = 2
+		real_check_url = uc.check_url
+		uc.check_url = fake_check_url
+		try:
+			updated = asyncio.run(uc.update_status_codes_async(urls, checks, 1, ctx))
+		finally:
+			uc.check_url = real_check_url
+
+		self.assertEqual(len(updated), len(urls))
+		self.assertLessEqual(most["example.org"], 2)
+		self.assertLessEqual(most["example.net"], 2)
+		self.assertLessEqual(most[""], 5)
+		self.assertGreater(most[""], 2)
+		self.assertEqual(checks[urls[0]]["checks"]["status"], 200)
+		bad = checks["https://example.com/bad"]["checks"]
+		self.assertEqual(bad["fail"]["from-code"], 404)
+
+	def test_freshness_ttl_hours(self):
+		freshness = {
+				"ttl_hours": 24,
+				"patterns": {
+				"^http[s]\\?://github\\.com/": 72,
+				"^https://example\\.org/never": 0,
+				},
+		}
+		url = "https://example.org/"
+		self.assertEqual(uc.freshness_ttl_hours(url, freshness), 24)
+		url = "http://github.com/foo"
+		self.assertEqual(uc.freshness_ttl_hours(url, freshness), 72)
+		url = "https://example.org/never"
+		self.assertEqual(uc.freshness_ttl_hours(url, freshness), 0)
+		self.assertEqual(uc.freshness_ttl_hours(url, {}), 0)
+
+		freshness["jitter"] = 0.5
+		ttls = set()
+		for i in range(10):
+			url = f"https://example.org/{i}"
+			ttl = uc.freshness_ttl_hours(url, freshness)
+			self.assertEqual(ttl, uc.freshness_ttl_hours(url, freshness))
+			self.assertGreater(ttl, 12)
+			self.assertLessEqual(ttl, 24)
+			ttls.add(ttl)
+		self.assertGreater(len(ttls), 1)
+
+	def test_stale_urls(self):
+		checks = {
+				"https://example.org/new": {
+				"checks": {}
+				},
+				"https://example.org/recent": {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-31 12:00:00.000000"
+				}
+				},
+				"https://example.org/old": {
+				"checks": {
+				"status": 200,
+				"200": "2023-03-30 12:00:00.000000"
+				}
+				},
+				"https://example.org/failing": {
+				"checks": {
+				"status": 404,
+				"200": "2023-03-31 12:00:00.000000",
+				"fail": {
+				"from": "2023-03-31 23:00:00.000000",
+				"from-code": 404
+				}
+				}
+				},
+		}
+		ctx = Test_Context()
+		ctx.now_time = "2023-04-01 00:00:00.000000"
+		self.assertEqual(uc.stale_urls(checks, ctx), list(checks.keys()))
+
+		ctx.freshness = {"ttl_hours": 24}
+		expected = [
+				"https://example.org/new",
+				"https://example.org/old",
+				"https://example.org/failing",
+		]
+		self.assertEqual(uc.stale_urls(checks, ctx), expected)
+		recent = checks["https://example.org/recent"]["checks"]
+		self.assertEqual(recent["outcome"], "skipped")
+		self.assertNotIn("outcome", checks["https://example.org/old"]["checks"])
+
+		ctx.freshness["patterns"] = {"/recent$": 6}
+		expected.insert(1, "https://example.org/recent")
+		self.assertEqual(uc.stale_urls(checks, ctx), expected)
+
+	def test_canonical_url(self):
+		expected = {
+				"https://x.org/page#a": "https://x.org/page",
+				"https://X.org/page": "https://x.org/page",
+				"https://x.org/page.": "https://x.org/page",
+				"https://x.org/page?q=1,": "https://x.org/page?q=1",
+				"HTTPS://x.org:443/page": "https://x.org/page",
+				"http://x.org:8080": "http://x.org:8080/",
+				"http://u:p@X.org:80/a?b=1#c": "http://u:p@x.org/a?b=1",
+				"http://[::1]:80/x": "http://[::1]/x",
+				"http://x.org:bad/": "http://x.org:bad/",
+				"NOT A VALID URL": "NOT A VALID URL",
+		}
+		for url, canonical in expected.items():
+			self.assertEqual(uc.canonical_url(url), canonical, url)
+
+	def test_update_status_codes_canonical(self):
+		urls = [
+				"https://example.org/page#a",
+				"https://example.org/page#b",
+				"https://EXAMPLE.org/page",
+				"https://example.org/page.",
+				"https://example.org/other",
+		]
+		checks = {url: {"url": url, "checks": {}, "used": {}} for url in urls}
+		checked = []
+
+		def fake_check_url(url, timeout, ctx=None):
+			checked.append(url)
+			return {"status": 200, "redirects": []}
+
+		ctx = Test_Context()
+		real_check_url = uc.check_url
+		uc.check_url = fake_check_url
+		try:
+			updated = asyncio.run(uc.update_status_codes_async(urls, checks, 1, ctx))
+		finally:
+			uc.check_url = real_check_url
+
+		self.assertEqual(
+				sorted(checked),
+				["https://example.org/other", "https://example.org/page"])
+		self.assertEqual(len(updated), len(urls))
+		for url in urls:
+			self.assertEqual(checks[url]["checks"]["status"], 200)
+
+	def test_group_by_registrable_domain(self):
 		ctx = Test_Context(capture=True, verbose=True)
 		urls = [
 				"http://example.org/foo.html",
-				"http://example.org/bar.html",
+				"http://www.example.org/bar.html",
 				"http://example.org/baz.html",
 				"http://example.net/whiz.html",
 				"http://example.net/bang.html",
+				"https://one.example.co.uk/",
+				"https://two.example.co.uk/",
+				"https://other.co.uk/",
+				"https://foo.github.io/x",
+				"https://bar.github.io/y",
 				"NOT A VALID URL",
+				"https://[0-9]+/",
 		]
-		actual = uc.group_by_second_level_domain(urls, ctx)
+		actual = uc.group_by_registrable_domain(urls, ctx)
 		expected = {
-				"": ["NOT A VALID URL"],
+				"": ["NOT A VALID URL", "https://[0-9]+/"],
 				"example.org": [
 				"http://example.org/foo.html",
-				"http://example.org/bar.html",
+				"http://www.example.org/bar.html",
 				"http://example.org/baz.html",
 				],
 				"example.net": [
 				"http://example.net/whiz.html",
 				"http://example.net/bang.html",
 				],
+				"example.co.uk": [
+				"https://one.example.co.uk/",
+				"https://two.example.co.uk/",
+				],
+				"other.co.uk": ["https://other.co.uk/"],
+				"foo.github.io": ["https://foo.github.io/x"],
+				"bar.github.io": ["https://bar.github.io/y"],
 		}
 		actual = sort_dict_of_lists(actual)
 		expected = sort_dict_of_lists(expected)
 		self.assertEqual(actual, expected)
 		self.assertEqual("", ctx.out)
 
+	def test_repo_results(self):
+		report_dir = "/tmp/url-check-tests/reports"
+		os.makedirs(report_dir, exist_ok=True)
+		ok = {"checks": {"status": 200}, "used": {"a": ["x.md"], "b": ["y.md"]}}
+		bad = {"checks": {"status": 404}, "used": {"b": ["z.md"]}}
+		gone = {"checks": {"status": 200}, "used": {"old": ["z.md"]}}
+		checks = {
+				"https://example.org/": ok,
+				"https://example.net/": bad,
+				"https://example.com/": gone,
+		}
+		repos_info = {"a": {}, "b": {}}
+
+		index = uc.urls_by_repo(checks, repos_info.keys())
+		self.assertEqual(
+				index, {
+				"a": {
+				"https://example.org/": ok
+				},
+				"b": {
+				"https://example.org/": ok,
+				"https://example.net/": bad
+				},
+				})
+
+		checks_path = os.path.join(report_dir, "checks.json")
+		fails_path = os.path.join(report_dir, "fails.json")
+		uc.repo_results(repos_info, checks, checks_path, fails_path, Test_Context())
+
+		a_checks = uc.read_json(os.path.join(report_dir, "a-checks.json"))
+		self.assertEqual(a_checks, index["a"])
+		b_fails = uc.read_json(os.path.join(report_dir, "b-fails.json"))
+		self.assertEqual(b_fails, {
+				"repos": {
+				"b": "failing"
+				},
+				"urls": {
+				"https://example.net/": bad
+				},
+		})
+		a_look = os.path.join(report_dir, "a-url-check-look.json")
+		self.assertEqual(
+				os.readlink(a_look),
+				os.path.abspath(os.path.join(report_dir, "a-checks.json")))
+		b_look = os.path.join(report_dir, "b-url-check-look.json")
+		self.assertEqual(
+				os.readlink(b_look),
+				os.path.abspath(fails_path.replace("fails.json", "b-fails.json")))
+
+	def test_registrable_domain(self):
+		psl_path = "/tmp/url-check-tests/test-psl.dat"
+		with open(psl_path, "w") as out_file:
+			out_file.write("// comment\n\nuk\nco.uk\nck\n*.ck\n!www.ck\n")
+		expected = {
+				"www.example.co.uk": "example.co.uk",
+				"example.co.uk": "example.co.uk",
+				"co.uk": "co.uk",
+				"a.b.example.org": "example.org",
+				"WWW.Example.ORG": "example.org",
+				"a.b.ck": "a.b.ck",
+				"x.a.b.ck": "a.b.ck",
+				"www.ck": "www.ck",
+				"foo.www.ck": "www.ck",
+				"localhost": "localhost",
+				"127.0.0.1": "127.0.0.1",
+				"[::1]": "[::1]",
+		}
+		for host, domain in expected.items():
+			self.assertEqual(uc.registrable_domain(host, psl_path), domain, host)
+		self.assertEqual(uc.registrable_domain("x.github.io", None), "x.github.io")
+
+	def test_update_status_codes_async_rate(self):
+		ctx = Test_Context()
+		ctx.per_host_rate = 20
+		with Test_Server() as server:
+			urls = [server.url + f"/status/20{i}" for i in range(5)]
+			checks = {url: {"url": url, "checks": {}, "used": {}} for url in urls}
+			start = time.monotonic()
+			asyncio.run(uc.update_status_codes_async(urls, checks, 1, ctx))
+			elapsed = time.monotonic() - start
+		self.assertGreaterEqual(elapsed, 0.2)
+		self.assertEqual(checks[urls[0]]["checks"]["status"], 200)
+		self.assertEqual(checks[urls[4]]["checks"]["fail"]["from-code"], 204)
+
 	def test_main_version(self):
 		argv = ['url-check', '--version']
 		ctx = Test_Context(capture=True)
 		uc.main(argv, ctx)
 		self.assertIn(uc.url_check_version, ctx.out)
 
+	def test_main_metrics(self):
+		test_dir = "/tmp/url-check-tests/main-metrics"
+		metrics_path = os.path.join(test_dir, "url-check.prom")
+		with Test_Server("127.0.0.2") as server:
+			urls = [server.url + "/status/200", server.url + "/status/404"]
+			argv = make_test_config(test_dir,
+					{"metrics-test": {
+					"a.md": " ".join(urls).encode("utf-8")
+					}})
+			with working_directory(test_dir):
+				uc.main(argv + [f"--metrics={metrics_path}"], Test_Context())
+		with open(metrics_path, "r") as in_file:
+			lines = in_file.read().splitlines()
+		for phase in ["sync", "extract", "resolve", "check", "report"]:
+			self.assertIn(f'url_check_phase_seconds{{phase="{phase}"}} 1.000', lines)
+		self.assertIn('url_check_urls{status="200"} 1', lines)
+		self.assertIn('url_check_urls{status="404"} 1', lines)
+		quantile = 'host="127.0.0.2",quantile="0.5"'
+		self.assertEqual(len([line for line in lines if quantile in line]), 1)
+		self.assertTrue(
+				os.path.exists(os.path.join(test_dir, "metrics-test-results.json")))
+
+	def test_main_profile(self):
+		test_dir = "/tmp/url-check-tests/main-profile"
+		profile_dir = os.path.join(test_dir, "profile")
+		with Test_Server("127.0.0.2") as server:
+			argv = make_test_config(test_dir, {
+					"profile-test": {
+					"a.md": (server.url + "/status/200").encode("utf-8")
+					}
+			})
+			with working_directory(test_dir):
+				uc.main(argv + [f"--profile={profile_dir}"], Quiet_Context())
+				self.assertIn("sync.pstats", os.listdir(profile_dir))
+
+				# the profile of the other commands is also written
+				subprocess.run(["rm", "-rf", profile_dir])
+				results_path = os.path.join(test_dir, "results.json")
+				merge_argv = argv[0:1] + ["merge"] + argv[1:]
+				uc.main(merge_argv + [f"--profile={profile_dir}", results_path],
+						Quiet_Context())
+		self.assertEqual(
+				sorted(os.listdir(profile_dir)),
+				["all.pstats", "main.pstats", "report.pstats", "summary.txt"])
+
+	def test_main_shards_and_merge(self):
+		test_dir = "/tmp/url-check-tests/main-shards"
+		with Test_Server("127.0.0.2") as one, Test_Server("127.0.0.3") as two:
+			urls = [one.url + "/status/200", two.url + "/status/404"]
+			argv = make_test_config(test_dir,
+					{"shards-test": {
+					"a.md": " ".join(urls).encode("utf-8")
+					}})
+			# the results of one shard in an SQLite database
+			argv = [arg for arg in argv if not arg.startswith("--results=")]
+			shard_paths = [
+					os.path.join(test_dir, "shard-1.db"),
+					os.path.join(test_dir, "shard-2.json"),
+			]
+			with working_directory(test_dir):
+				for i, shard_path in enumerate(shard_paths):
+					uc.main(argv + [f"--shard={i + 1}/2", f"--results={shard_path}"],
+							Test_Context())
+				# a sharded run only writes its results
+				self.assertFalse(os.path.exists("url-check-fails.json"))
+
+				results_path = os.path.join(test_dir, "results.db")
+				merge_argv = argv[0:1] + ["merge"] + argv[1:]
+				uc.main(merge_argv + [f"--results={results_path}"] + shard_paths,
+						Test_Context())
+			requested = one.requests + two.requests
+
+		# each URL was checked by one of the shards, a failing HEAD is
+		# retried with a GET
+		self.assertEqual(
+				sorted(requested), [("GET", "/status/404"), ("HEAD", "/status/200"),
+				("HEAD", "/status/404")])
+		checks = uc.Sqlite_Store(results_path).load()
+		self.assertEqual(checks[urls[0]]["checks"]["status"], 200)
+		self.assertEqual(checks[urls[1]]["checks"]["status"], 404)
+		# the reports of the merged results are JSON
+		fails = uc.read_results(os.path.join(test_dir, "url-check-fails.json"))
+		self.assertEqual(fails["repos"], {"shards-test": "failing"})
+		self.assertEqual(list(fails["urls"].keys()), [urls[1]])
+		repo_results = os.path.join(test_dir, "shards-test-results.json")
+		self.assertEqual(uc.read_results(repo_results), checks)
+
+	def test_main_incremental(self):
+		test_dir = "/tmp/url-check-tests/main-incremental"
+		origin = os.path.join(test_dir, "origins", "incremental-test")
+		commits_path = os.path.join(test_dir, "results-commits.json")
+		results_path = os.path.join(test_dir, "results.json")
+		with Test_Server("127.0.0.2") as server:
+			urls = [server.url + f"/status/{code}" for code in [200, 201, 404]]
+			argv = make_test_config(
+					test_dir, {
+					"incremental-test": {
+					"a.md": urls[0].encode("utf-8"),
+					"b.md": urls[1].encode("utf-8"),
+					}
+					})
+			argv += ["--incremental", "--extract=blobs"]
+			with working_directory(test_dir):
+				uc.main(argv, Test_Context())
+				first = uc.read_json(commits_path)
+				first_requested = len(server.requests)
+
+				# b.md is deleted and c.md added
+				make_test_repo(origin, {
+						"a.md": urls[0].encode("utf-8"),
+						"c.md": urls[2].encode("utf-8"),
+				})
+				ctx = Test_Context(capture=True)
+				uc.main(argv, ctx)
+				second = uc.read_json(commits_path)
+				second_requested = server.requests[first_requested:]
+				second_count = len(server.requests)
+				checks = uc.read_results(results_path)
+
+				# a change of the settings extracts all of the files again
+				config_path = os.path.join(test_dir, "config.json")
+				config = uc.read_json(config_path)
+				config["ignore_patterns"] = {"https://example.org/": "example"}
+				uc.write_json(config_path, config)
+				settings_ctx = Test_Context(capture=True)
+				uc.main(argv, settings_ctx)
+				third = uc.read_json(commits_path)
+			third_requested = server.requests[second_count:]
+
+		# the commit of the bare clone is recorded, with the settings
+		commit = first["repos"]["incremental-test"]
+		self.assertRegex(commit, "^[0-9a-f]{40}$")
+		self.assertEqual(first["repos_settings"]["incremental-test"]["extract"],
+				"blobs")
+		# the next run only extracts the changed file, and checks its new URL
+		self.assertIn(" incremental-test has 1 changed files\n", ctx.out)
+		self.assertEqual(set(path for _, path in second_requested), {"/status/404"})
+		self.assertEqual(sorted(checks.keys()), [urls[0], urls[2]])
+		self.assertNotEqual(second["repos"]["incremental-test"], commit)
+		self.assertEqual(second["settings"], first["settings"])
+		# the commits of other settings are not read
+		self.assertNotIn("changed files", settings_ctx.out)
+		self.assertEqual(third_requested, [])
+		self.assertNotEqual(third["settings"], second["settings"])
+		self.assertEqual(third["repos"], second["repos"])
+
+	def test_main_incremental_ignore_files(self):
+		test_dir = "/tmp/url-check-tests/main-incremental-ignore"
+		with Test_Server("127.0.0.2") as server:
+			urls = [server.url + "/status/200", server.url + "/status/404"]
+			argv = make_test_config(
+					test_dir, {
+					"ignore-test": {
+					"a.md": urls[0].encode("utf-8"),
+					"skip.md": urls[1].encode("utf-8"),
+					}
+					})
+			config_path = os.path.join(test_dir, "config.json")
+			config = uc.read_json(config_path)
+			repo = config["repositories"]["ignore-test"]
+			repo["ignore_files"] = {"skip.md": "not yet checked"}
+			uc.write_json(config_path, config)
+			results_path = os.path.join(test_dir, "results.json")
+			with working_directory(test_dir):
+				uc.main(argv + ["--incremental"], Test_Context())
+				first = uc.read_results(results_path)
+				# skip.md is no longer ignored, though it has not changed
+				del repo["ignore_files"]
+				uc.write_json(config_path, config)
+				uc.main(argv + ["--incremental"], Test_Context())
+				second = uc.read_results(results_path)
+
+		self.assertEqual(list(first.keys()), urls[0:1])
+		self.assertEqual(second[urls[1]]["used"], {"ignore-test": ["skip.md"]})
+		self.assertEqual(second[urls[1]]["checks"]["status"], 404)
+		state = uc.read_json(os.path.join(test_dir, "results-commits.json"))
+		self.assertEqual(state["repos_settings"],
+				{"ignore-test": {
+				"extract": "files",
+				"ignore_files": []
+				}})
+
 	def test_main(self):
 		gits_dir = '/tmp/url-check-tests/gits'
 		config_path = os.path.join(gits_dir, 'test-repos.json')